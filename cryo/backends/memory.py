@@ -24,10 +24,116 @@ __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
+import functools
+import heapq
+import itertools
+import operator
+import re
+
 from .. import util
 from .. import exceptions
-from ..connection import Backend, ConnectedBackend
-from ..query import CompareWhereClause, AndWhereClause, OrWhereClause, Field
+from ..connection import Backend, ConnectedBackend, Unloaded
+from ..datatypes import One
+from ..query import CompareWhereClause, AndWhereClause, OrWhereClause, \
+                    InWhereClause, BetweenWhereClause, LikeWhereClause, \
+                    NullWhereClause, Field, Param, Aggregate, Count, Sum, \
+                    Min, Max, bindvalue
+
+
+_COMPARATORS = {'=': operator.eq,
+                '>': operator.gt,
+                '>=': operator.ge,
+                '<': operator.lt,
+                '<=': operator.le,
+                '!=': operator.ne}
+
+_AGGREGATES = {Count: lambda total, value: total + 1,
+               Sum: operator.add,
+               Min: min,
+               Max: max}
+
+
+def _initial(item):
+    """Returns the value of an item of a projection over no rows"""
+
+    if isinstance(item, Count):
+        return 0
+    return None
+
+
+def _operand(value):
+    """Returns a function getting value from an object and the Params"""
+
+    if isinstance(value, Field):
+        return lambda obj, params, name=value.name: getattr(obj, name)
+    elif isinstance(value, Param):
+        return lambda obj, params: bindvalue(value, params)
+    else:
+        return lambda obj, params: value
+
+
+def _likeregex(pattern):
+    """Translates a LIKE pattern to a regular expression"""
+
+    regex = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            regex.append(re.escape(char))
+            escaped = False
+        elif char == LikeWhereClause.escape:
+            escaped = True
+        elif char == '%':
+            regex.append('.*')
+        elif char == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char))
+    regex.append('$')
+
+    # LIKE ignores case, as on SQLite
+    return re.compile("".join(regex), re.DOTALL | re.IGNORECASE)
+
+
+class _Index(object):
+    """
+    Maps the values of the indexed columns of the objects of a table to their
+    hash keys.
+    """
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.types = [table.columns[attr].datatype.type()
+                      for attr in index.columns]
+        self.entries = {}
+        self.keys = {}
+
+    def key(self, values):
+        try:
+            return tuple([value is not None and type(value) or None
+                          for type, value in zip(self.types, values)])
+        except (TypeError, ValueError):
+            return tuple(values)
+
+    def keyof(self, obj):
+        return self.key([getattr(obj, attr) for attr in self.index.columns])
+
+    def add(self, hashkey, obj):
+        self.remove(hashkey)
+        key = self.keyof(obj)
+        self.entries.setdefault(key, set()).add(hashkey)
+        self.keys[hashkey] = key
+
+    def remove(self, hashkey):
+        if hashkey in self.keys:
+            key = self.keys.pop(hashkey)
+            self.entries[key].discard(hashkey)
+            if not self.entries[key]:
+                del self.entries[key]
+
+    def get(self, key):
+        return self.entries.get(key, ())
 
 
 class MemoryBackend(Backend):
@@ -35,6 +141,8 @@ class MemoryBackend(Backend):
     def __init__(self):
         self.tables = {}
         self.values = {}
+        # _Index lists by table name
+        self.indexes = {}
 
     def connect(self, session):
         return MemoryConnectedBackend(self, session)
@@ -43,108 +151,429 @@ class MemoryBackend(Backend):
 
 class MemoryConnectedBackend(ConnectedBackend):
 
+    sharesobjects = True
+
     def __init__(self, backend, session):
         ConnectedBackend.__init__(self, backend, session)
         self._values = {}
         self._deletedvalues = {}
+        # Hash keys inserted in this transaction by (unique index, key)
+        self._uniquekeys = {}
 
     def createtable(self, table):
         util.QUERY_LOGGER.debug("CREATE TABLE %s" % table.name)
         self.backend.tables[table.name] = True
+        self.backend.indexes.setdefault(table.name, [])
+
+    def createindex(self, table, index):
+        indexes = self.backend.indexes.setdefault(table.name, [])
+        if index.name in [index_.index.name for index_ in indexes]:
+            return
+
+        util.QUERY_LOGGER.debug("CREATE INDEX %s" % index.name)
+        index_ = _Index(table, index)
+        for hashkey, obj in self.backend.values.items():
+            if self.session.connection.tables.get(
+                    util.fullname(obj.__class__)) is table:
+                index_.add(hashkey, obj)
+        indexes.append(index_)
 
     def insert(self, *objs):
-        for obj in util.flatten(objs):
-            hashkey = self.gethashkey(obj) 
+        objs = util.flatten(objs)
+        for obj, hashkey in zip(objs, self.gethashkeys(objs)):
             util.QUERY_LOGGER.debug("INSERT %s => %s" % (hashkey, obj))
+            self._checkunique(obj, hashkey)
             self._values[hashkey] = obj
 
+    def _checkunique(self, obj, hashkey):
+        table = self.session.gettable(obj=obj)
+        for index in self.backend.indexes.get(table.name, []):
+            if not index.index.unique:
+                continue
+
+            key = index.keyof(obj)
+            if None in key:
+                continue
+
+            # Objects are shared with the session, so the ones already stored
+            # are checked against their current values
+            others = self._uniquekeys.setdefault((index.index.name, key),
+                                                 set())
+            for other in others.union(index.get(key)):
+                if other == hashkey or other in self._deletedvalues:
+                    continue
+                if other in self._values:
+                    value = self._values[other]
+                else:
+                    value = self.backend.values[other]
+                if index.keyof(value) == key:
+                    raise exceptions.DuplicateEntry(index.index.name)
+            others.add(hashkey)
+
     def delete(self, *objs):
-        for obj in util.flatten(objs):
-            hashkey = self.gethashkey(obj)
+        objs = util.flatten(objs)
+        for obj, hashkey in zip(objs, self.gethashkeys(objs)):
             if hashkey in self._values:
                 util.QUERY_LOGGER.debug("DELETE %s => %s" % (hashkey, obj))
                 del self._values[hashkey]
             self._deletedvalues[hashkey] = True
 
     def get(self, table, hashkey):
-        util.QUERY_LOGGER.debug("GET %s" % hashkey)
+        util.QUERY_LOGGER.debug("GET %s" % (hashkey, ))
         return self.backend.values[hashkey]
 
-    def query(self, select):
-        util.QUERY_LOGGER.debug("SELECT %s" % select)
+    def getmany(self, table, hashkeys):
+        util.QUERY_LOGGER.debug("GET %s" % (hashkeys, ))
+        return [self.backend.values.get(hashkey) for hashkey in hashkeys]
+
+    def getcollections(self, table, name, objs):
+        target, inverse = self.getinverse(table, name)
+        indexes = dict((hashkey, index) for index, hashkey in
+                       enumerate(self.gethashkeys(objs)))
+
+        results = [[] for obj in objs]
+        for key, value in self.backend.values.items():
+            if util.fullname(value.__class__) != target.classname:
+                continue
+            owner = self.getvalue(value, inverse)
+            if owner is None:
+                continue
+            index = indexes.get(self.gethashkey(owner))
+            if index is not None:
+                results[index].append(value)
+        return results
+
+    def query(self, select, track=True):
         table = self.session.connection.tables[select.classname]
+        predicate = self._predicate(select.whereclause, table)
+        for obj in self._prefetched(select, self._results(table, select,
+                                                          predicate, {},
+                                                          track),
+                                    track):
+            yield obj
+
+    def execute(self, prepared, params):
+        table = self.session.connection.tables[prepared.classname]
+        compiled = prepared.compiled.get(self.backend)
+        if compiled is None or compiled[0] is not table:
+            compiled = (table, self._predicate(prepared.select.whereclause,
+                                               table))
+            prepared.compiled[self.backend] = compiled
+
+        for obj in self._prefetched(prepared.select,
+                                    self._results(table, prepared.select,
+                                                  compiled[1], params)):
+            yield obj
+
+    def _prefetched(self, select, results, track=True):
+        """Yields results with the Many attributes select prefetches loaded"""
+
+        if select.projection or not select.prefetches:
+            for result in results:
+                yield result
+            return
+
+        objs = list(results)
+        self.session.prefetch(objs, *select.prefetches, track=track)
+        for obj in objs:
+            yield obj
+
+    def _results(self, table, select, predicate, params, track=True):
+        util.QUERY_LOGGER.debug("SELECT %s" % select)
         if table.name not in self.backend.tables:
             raise exceptions.TableDoesNotExist(table.name)
 
-        results = []
-        count = 0
+        names = list(select.groupbys)
+        for item in select.projection:
+            if not isinstance(item, Aggregate):
+                names.append(item)
+            elif item.field is not None:
+                names.append(item.field)
+        for name in names:
+            if name not in table.columns:
+                raise ValueError("%s is not a column of %s"
+                                 % (name, table.name))
+
         start = select.limitclause and select.limitclause.start or 0
         end = select.limitclause and select.limitclause.end
-        for key, obj in self.backend.values.items():
-            if isinstance(obj, select.class_):
-                if self._where(obj, select.whereclause, table):
-                    if select.orderbyclauses:
-                        results.append(obj)
-                    else:
-                        if count >= start and (end is None or count < end):
-                            hashkey = self.gethashkey(obj)
-                            self._values[hashkey] = obj
-                            yield obj
-                        count += 1
+        objs = (obj for key, obj in self._candidates(select.whereclause,
+                                                     table, params)
+                if isinstance(obj, select.class_) and predicate(obj, params))
+
+        if select.aggregates():
+            results = self._aggregate(table, select, objs)
+            results.sort(cmp=self._orderby(select.orderbyclauses))
+            for record in results[start:end]:
+                yield record
+            return
+
+        if select.keyset:
+            for obj in self._seek(select, objs, start, end):
+                yield self._result(obj, table, select, track)
+            return
+
+        results = []
+        count = 0
+        for obj in objs:
+            if select.orderbyclauses:
+                results.append(obj)
+            else:
+                if count >= start and (end is None or count < end):
+                    yield self._result(obj, table, select, track)
+                count += 1
 
         results.sort(cmp=self._orderby(select.orderbyclauses))
 
         for obj in results[start:end]:
-            hashkey = self.gethashkey(obj)
-            self._values[hashkey] = obj
-            yield obj
+            yield self._result(obj, table, select, track)
+
+    def _seek(self, select, objs, start, end):
+        """
+        Returns the objs after select.afterkey in the order of its fields and
+        hash key. With a limit only the first end objs are kept while going
+        through them.
+        """
+
+        if (select.afterkey is not None and
+            len(select.afterkey) != len(select.orderbyclauses) + 1):
+            raise ValueError("%s should have a value for each ordered field "
+                             "and the hash key" % (select.afterkey, ))
+
+        directions = [orderbyclause.ascending
+                      for orderbyclause in select.orderbyclauses] + [True]
+
+        def compare(key1, key2):
+            for value1, value2, ascending in zip(key1, key2, directions):
+                result = cmp(value1, value2)
+                if result:
+                    return ascending and result or -result
+            return 0
+
+        keys = ((self.session.keyof(obj, select), obj) for obj in objs)
+        if select.afterkey is not None:
+            keys = ((key, obj) for key, obj in keys
+                    if compare(key, select.afterkey) > 0)
+
+        sortkey = functools.cmp_to_key(lambda a, b: compare(a[0], b[0]))
+        if end is None:
+            results = sorted(keys, key=sortkey)
+        else:
+            results = heapq.nsmallest(end, keys, key=sortkey)
+        return [obj for key, obj in results[start:end]]
+
+    def _result(self, obj, table, select, track=True):
+        if select.projection:
+            return select.record()(*[self._recordvalue(obj, table, name)
+                                     for name in select.projection])
+
+        # Untracked objects aren't hashed, as that caches their hash keys
+        if track:
+            self._values[self.gethashkey(obj)] = obj
+        return obj
+
+    def _recordvalue(self, obj, table, name):
+        value = self.getvalue(obj, name)
+        if isinstance(value, Unloaded):
+            return value.hashkey
+        elif value is not None and isinstance(table.columns[name].datatype,
+                                              One):
+            return self.gethashkey(value)
+        return value
+
+    def _aggregate(self, table, select, objs):
+        """
+        Returns the records of the Aggregates of select, computed in a single
+        pass over objs. Columns that aren't grouped get the value of the
+        first object of each group.
+        """
+
+        groups = {}
+        for obj in objs:
+            key = tuple([self._recordvalue(obj, table, name)
+                         for name in select.groupbys])
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = []
+                for item in select.projection:
+                    if isinstance(item, Aggregate):
+                        totals.append(_initial(item))
+                    else:
+                        totals.append(self._recordvalue(obj, table, item))
+
+            for index, item in enumerate(select.projection):
+                if not isinstance(item, Aggregate):
+                    continue
+                elif item.field is None:
+                    value = obj
+                else:
+                    value = self._recordvalue(obj, table, item.field)
+
+                if value is None:
+                    continue
+                elif totals[index] is None:
+                    totals[index] = value
+                else:
+                    totals[index] = _AGGREGATES[item.__class__](totals[index],
+                                                                value)
+
+        if not groups and not select.groupbys:
+            # Aggregates over no rows still give one record
+            groups[()] = [_initial(item) for item in select.projection]
+
+        record = select.record()
+        return [record(*totals) for totals in groups.values()]
+
+    def _candidates(self, whereclause, table, params):
+        """
+        Returns the stored objects that may match whereclause, narrowed down
+        with the widest index covered by its equality comparisons.
+        """
+
+        values = self._equalities(whereclause)
+        best = None
+        for index in self.backend.indexes.get(table.name, []):
+            if (set(index.index.columns) <= set(values) and
+                (best is None or
+                 len(index.index.columns) > len(best.index.columns))):
+                best = index
+
+        if best is None:
+            return self.backend.values.items()
+
+        util.QUERY_LOGGER.debug("USING INDEX %s" % best.index.name)
+        alternatives = [[bindvalue(value, params) for value in values[attr]]
+                        for attr in best.index.columns]
+        hashkeys = []
+        seen = set()
+        for key in itertools.product(*alternatives):
+            for hashkey in best.get(best.key(key)):
+                if hashkey not in seen:
+                    seen.add(hashkey)
+                    hashkeys.append(hashkey)
+        return [(hashkey, self.backend.values[hashkey])
+                for hashkey in hashkeys]
+
+    def _equalities(self, whereclause):
+        """
+        Returns the values that whereclause requires fields to be equal to
+        (any of them, for IN clauses).
+        """
+
+        if isinstance(whereclause, AndWhereClause):
+            values = self._equalities(whereclause.whereclause1)
+            values.update(self._equalities(whereclause.whereclause2))
+            return values
+        elif (isinstance(whereclause, CompareWhereClause) and
+              whereclause.comparator == '='):
+            value1, value2 = whereclause.value1, whereclause.value2
+            if isinstance(value2, Field):
+                value1, value2 = value2, value1
+            if isinstance(value1, Field) and not isinstance(value2, Field):
+                return {value1.name: [value2]}
+        elif isinstance(whereclause, InWhereClause):
+            return {whereclause.field.name: list(whereclause.values)}
+        return {}
+
+    def _predicate(self, whereclause, table):
+        """
+        Compiles whereclause into a function telling whether an object
+        matches it, given the values of the Params.
+        """
 
-    def _where(self, obj, whereclause, table):
         if whereclause is None:
-            return True
+            return lambda obj, params: True
         elif isinstance(whereclause, CompareWhereClause):
-            return self._compare(obj, whereclause, table)
-        elif isinstance(whereclause, AndWhereClause): 
-            return (self._where(obj, whereclause.whereclause1, table) and
-                    self._where(obj, whereclause.whereclause2, table))
-        elif isinstance(whereclause, OrWhereClause): 
-            return (self._where(obj, whereclause.whereclause1, table) or
-                    self._where(obj, whereclause.whereclause2, table))
+            return self._comparison(whereclause, table)
+        elif isinstance(whereclause, AndWhereClause):
+            predicate1 = self._predicate(whereclause.whereclause1, table)
+            predicate2 = self._predicate(whereclause.whereclause2, table)
+            return lambda obj, params: (predicate1(obj, params) and
+                                        predicate2(obj, params))
+        elif isinstance(whereclause, OrWhereClause):
+            predicate1 = self._predicate(whereclause.whereclause1, table)
+            predicate2 = self._predicate(whereclause.whereclause2, table)
+            return lambda obj, params: (predicate1(obj, params) or
+                                        predicate2(obj, params))
+        elif isinstance(whereclause, InWhereClause):
+            return self._membership(whereclause, table)
+        elif isinstance(whereclause, BetweenWhereClause):
+            type = table.columns[whereclause.field.name].datatype.type()
+            name = whereclause.field.name
+            low = _operand(whereclause.low)
+            high = _operand(whereclause.high)
+
+            def between(obj, params):
+                value = getattr(obj, name)
+                return (value is not None and
+                        type(low(obj, params)) <= type(value) <=
+                        type(high(obj, params)))
+            return between
+        elif isinstance(whereclause, LikeWhereClause):
+            name = whereclause.field.name
+            pattern = whereclause.pattern
+            if isinstance(pattern, Param):
+                regex = lambda params: _likeregex(bindvalue(pattern, params))
+            else:
+                compiled = _likeregex(pattern)
+                regex = lambda params: compiled
+
+            def like(obj, params):
+                value = getattr(obj, name)
+                if value is None:
+                    return False
+                if not isinstance(value, basestring):
+                    value = unicode(value)
+                return regex(params).match(value) is not None
+            return like
+        elif isinstance(whereclause, NullWhereClause):
+            name, null = whereclause.field.name, whereclause.null
+            return lambda obj, params: (getattr(obj, name) is None) == null
         else:
             raise NotImplementedError(whereclause)
 
-    def _compare(self, obj, whereclause, table):
-        value1 = whereclause.value1
-        value2 = whereclause.value2
-        type = int
-
-        if isinstance(value1, Field) and isinstance(value2, Field):
-            type = table.columns[value1.name].datatype.type()
-            value1 = getattr(obj, value1.name)
-            value2 = getattr(obj, value2.name)
-        elif isinstance(value1, Field):
-            type = table.columns[value1.name].datatype.type()
-            value1 = getattr(obj, value1.name)
-        elif isinstance(value2, Field):
-            type = value1.__class__
-            value2 = getattr(obj, value2.name)
-        else:
-            type = value1.__class__
-
-        if whereclause.comparator == '=':
-            return type(value1) == type(value2)
-        elif whereclause.comparator == '>':
-            return type(value1) > type(value2)
-        elif whereclause.comparator == '>=':
-            return type(value1) >= type(value2)
-        elif whereclause.comparator == '<':
-            return type(value1) < type(value2)
-        elif whereclause.comparator == '<=':
-            return type(value1) <= type(value2)
-        elif whereclause.comparator == '!=':
-            return type(value1) != type(value2)
+    def _membership(self, whereclause, table):
+        type = table.columns[whereclause.field.name].datatype.type()
+        name = whereclause.field.name
+
+        def convert(values):
+            return set([type(value) for value in values if value is not None])
+
+        if [value for value in whereclause.values if isinstance(value, Param)]:
+            values = lambda params: convert([bindvalue(value, params)
+                                             for value in whereclause.values])
         else:
+            converted = convert(whereclause.values)
+            values = lambda params: converted
+
+        def membership(obj, params):
+            value = getattr(obj, name)
+            return value is not None and type(value) in values(params)
+
+        return membership
+
+    def _comparison(self, whereclause, table):
+        if whereclause.comparator not in _COMPARATORS:
             raise NotImplementedError(whereclause.comparator)
+        compare = _COMPARATORS[whereclause.comparator]
+
+        value1 = _operand(whereclause.value1)
+        value2 = _operand(whereclause.value2)
+        if isinstance(whereclause.value1, Field):
+            # Values are compared as the type of the column
+            type = table.columns[whereclause.value1.name].datatype.type()
+        else:
+            type = None
+
+        def comparison(obj, params):
+            a = value1(obj, params)
+            b = value2(obj, params)
+            if a is None or b is None:
+                # As on SQL, comparing with null is never true
+                return False
+            type_ = type or a.__class__
+            return compare(type_(a), type_(b))
+
+        return comparison
 
     def _orderby(self, orderbyclauses):
         def cmp_(a, b):
@@ -164,10 +593,20 @@ class MemoryConnectedBackend(ConnectedBackend):
             if key in self.backend.values:
                 del self.backend.values[key]
 
+        for hashkey, obj in self._values.items():
+            table = self.session.gettable(obj=obj)
+            for index in self.backend.indexes.get(table.name, []):
+                index.add(hashkey, obj)
+        for hashkey in self._deletedvalues:
+            for indexes in self.backend.indexes.values():
+                for index in indexes:
+                    index.remove(hashkey)
+
     def rollback(self):
         util.QUERY_LOGGER.debug("ROLLBACK")
         self._values = {}
         self._deletedvalues = {}
+        self._uniquekeys = {}
 
     def disconnect(self):
         pass
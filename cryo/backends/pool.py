@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copyright (C) 2008  César Izurieta
+
+This file is part of Cryo.
+
+Cryo is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import with_statement
+
+__author__ = "César Izurieta"
+__email__ = "cesar at caih dot org"
+__version__ = "$Revision$"[11:-2]
+
+import threading
+import time
+
+from .. import exceptions
+
+
+class Pool(object):
+    """
+    A bounded pool of database connections shared by sessions.
+
+    connect opens a new connection and reset is called on every connection
+    that is returned so the next session gets it in a clean state. If size
+    is not None at most size connections are open at the same time: checkout
+    waits for one to be returned when all of them are in use, raising
+    PoolTimeout after timeout seconds if timeout is not None. At most maxidle
+    connections are kept open while not in use, the ones returned after
+    that are closed.
+    """
+
+    def __init__(self, connect, reset, size=None, timeout=None, maxidle=5):
+        self.connect = connect
+        self.reset = reset
+        self.size = size
+        self.timeout = timeout
+        self.maxidle = maxidle
+        self._idle = []
+        self._opened = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._waittime = 0.0
+        self._condition = threading.Condition()
+
+    def checkout(self):
+        with self._condition:
+            if not self._idle and self._full():
+                self._wait()
+
+            self._checkouts += 1
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+
+        try:
+            return self.connect()
+        except:
+            self._discard()
+            raise
+
+    def _wait(self):
+        start = time.time()
+        self._waits += 1
+        try:
+            while not self._idle and self._full():
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise exceptions.PoolTimeout(self.size, self.timeout)
+                self._condition.wait(remaining)
+        finally:
+            self._waittime += time.time() - start
+
+    def _full(self):
+        return self.size is not None and self._opened >= self.size
+
+    def checkin(self, connection):
+        try:
+            self.reset(connection)
+        except Exception:
+            # A connection that can't be reset is not given to anyone else
+            self._discard()
+            connection.close()
+            return
+
+        with self._condition:
+            if self.maxidle is None or len(self._idle) < self.maxidle:
+                self._idle.append(connection)
+                self._condition.notify()
+                return
+
+        self._discard()
+        connection.close()
+
+    def _discard(self):
+        with self._condition:
+            self._opened -= 1
+            self._condition.notify()
+
+    def close(self):
+        """Closes the connections that are not in use"""
+
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """
+        Returns the size of the pool and how many idle connections it keeps,
+        how many connections are open, idle and in use, how many checkouts
+        there were, how many of them had to wait and the total and average
+        seconds spent waiting.
+        """
+
+        with self._condition:
+            return {'size': self.size,
+                    'maxidle': self.maxidle,
+                    'opened': self._opened,
+                    'idle': len(self._idle),
+                    'inuse': self._opened - len(self._idle),
+                    'checkouts': self._checkouts,
+                    'waits': self._waits,
+                    'waittime': self._waittime,
+                    'averagewaittime': (self._waits and
+                                        self._waittime / self._waits or 0.0)}
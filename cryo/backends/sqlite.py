@@ -28,11 +28,20 @@ import sqlite3
 import pickle
 import base64
 
-from .standardsql import StandardSQLBackend, StandardSQLConnectedBackend
+from .standardsql import StandardSQLBackend, StandardSQLConnectedBackend, \
+                         _ID_FIELD_NAME, _JOIN_ALIAS, _MAXINVALUES, \
+                         _parameters, _queryshape
+from .pool import Pool
+from ..connection import Unloaded, setunloaded
+from ..query import Aggregate, Count, Sum, LimitClause
+from ..collection import Collection
 from .. import util
 from .. import exceptions
 from .. import datatypes
 
+# How _cryo_id was declared before it was a real primary key
+_LEGACY_ID_DEFINITION = "%s PRIMARY_KEY UNIQUE" % _ID_FIELD_NAME
+
 
 def _todb(value):
     """Converts a value to be stored on the database"""
@@ -45,11 +54,13 @@ def _todb(value):
         return value.value.index
     elif isinstance(value.column.datatype, datatypes.PythonObject):
         return base64.encodestring(pickle.dumps(value.value, 2))
+    elif isinstance(value.column.datatype, datatypes.Binary):
+        return value.value is not None and buffer(value.value) or None
     if isinstance(value.column.datatype, datatypes.ForeignKey):
         if value.value is None:
-            return 0
+            return None
         else:
-            return value.connectedbackend.gethashkey(value.value)
+            return value.connectedbackend.getdbhashkey(value.value)
     else:
         return value.value
 
@@ -63,6 +74,8 @@ def _fromdb(value, column):
         return pickle.loads(base64.decodestring(value))
     elif issubclass(class_, datatypes.Boolean):
         return value == True or int(value) == 1
+    elif issubclass(class_, datatypes.Binary):
+        return value is not None and str(value) or None
     elif issubclass(class_, datatypes.Enum):
         return column.datatype.enum[int(value)]
     elif issubclass(class_, datatypes.One):
@@ -77,23 +90,96 @@ def _fromdb(value, column):
 
 class SQLiteBackend(StandardSQLBackend):
 
-    def __init__(self, uri, modules=None):
-        StandardSQLBackend.__init__(self, uri, modules)
+    def __init__(self, uri, modules=None, chunksize=500, poolsize=None,
+                 pooltimeout=None, withoutrowid=False, querycachesize=256,
+                 fetchsize=None, poolmaxidle=5):
+        StandardSQLBackend.__init__(self, uri, modules, querycachesize)
+        self.chunksize = chunksize
+        # Rows of query results read and hydrated at a time
+        self.fetchsize = fetchsize or chunksize
+        self.withoutrowid = withoutrowid
+        self.pool = Pool(self._connect, self._reset, poolsize, pooltimeout,
+                         poolmaxidle)
 
     def connect(self, session):
         return SQLiteConnectedBackend(self, session)
 
+    def _connect(self):
+        util.QUERY_LOGGER.debug("CONNECT %s", self.uri)
+        # Connections go back to the pool, so any thread can get them
+        connection = sqlite3.connect(self.uri,
+                                     detect_types=sqlite3.PARSE_COLNAMES,
+                                     check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def _reset(self, connection):
+        connection.rollback()
+
+    def close(self):
+        self.pool.close()
+
 
 class SQLiteConnectedBackend(StandardSQLConnectedBackend):
 
     def __init__(self, backend, session):
         StandardSQLConnectedBackend.__init__(self, backend, session)
-        self.connection = sqlite3.connect(backend.uri,
-                                          detect_types=sqlite3.PARSE_COLNAMES)
-        self.connection.row_factory = sqlite3.Row
+        self.connection = backend.pool.checkout()
 
     def createtable(self, table):
-        query = self._createtable(table)
+        results = self.connection.execute("SELECT sql FROM sqlite_master "
+                                          "WHERE type = 'table' AND name = ?",
+                                          (table.name, )).fetchall()
+        if not results:
+            self._execute(self._createtable(table, self._tableoptions(table)))
+        elif _LEGACY_ID_DEFINITION in results[0]['sql']:
+            self._upgradetable(table)
+
+    def createindex(self, table, index):
+        self._execute(self._createindex(table, index))
+
+    def _upgradetable(self, table):
+        """
+        Rebuilds a table created when _cryo_id was not a primary key, copying
+        the columns that still exist. Foreign keys used to store 0 for None.
+        """
+
+        oldname = "%s_cryo_old" % table.name
+        oldcolumns = [row['name'] for row in
+                      self.connection.execute("PRAGMA table_info('%s')"
+                                              % table.name)]
+
+        names = [_ID_FIELD_NAME]
+        values = ["'%s'.%s" % (oldname, _ID_FIELD_NAME)]
+        for column in table.columns.values():
+            if column.name in oldcolumns:
+                names.append("'%s'" % column.name)
+                value = "'%s'.'%s'" % (oldname, column.name)
+                if isinstance(column.datatype, datatypes.ForeignKey):
+                    value = "NULLIF(%s, 0)" % value
+                values.append(value)
+
+        self._execute("ALTER TABLE '%s' RENAME TO '%s'" % (table.name,
+                                                           oldname))
+        self._execute(self._createtable(table, self._tableoptions(table)))
+        self._execute("INSERT INTO '%s' (%s) SELECT %s FROM '%s'"
+                      % (table.name, ", ".join(names), ", ".join(values),
+                         oldname))
+        self._execute("DROP TABLE '%s'" % oldname)
+
+    def _tableoptions(self, table):
+        if self.backend.withoutrowid and self._idtype(table) != 'integer':
+            return " WITHOUT ROWID"
+        return ''
+
+    def _idtype(self, table):
+        datatype = table.hashkey.datatype
+        if isinstance(datatype, datatypes.Number) and not datatype.decimals:
+            # Makes _cryo_id an alias of the rowid
+            return 'integer'
+        return self.gettype(datatype)
+
+    def _execute(self, query):
         util.QUERY_LOGGER.debug(query)
         self.connection.execute(query)
 
@@ -104,59 +190,330 @@ class SQLiteConnectedBackend(StandardSQLConnectedBackend):
             return 'number(%s, %s)' % (datatype.length, datatype.decimals)
         elif isinstance(datatype, datatypes.Timestamp):
             return 'timestamp'
+        elif isinstance(datatype, datatypes.Binary):
+            return 'blob'
         elif isinstance(datatype, datatypes.ForeignKey):
             return 'integer'
         else:
             return 'text'
 
     def insert(self, *objs):
-        for query, values in self._insert(*objs):
-            util.QUERY_LOGGER.debug("%s => %s" % (query, _todb(values)))
-            self.connection.execute(query, _todb(values))
+        for query, rows in self._insert(*objs):
+            try:
+                self._executemany(query, rows)
+            except sqlite3.IntegrityError, e:
+                if 'UNIQUE' not in str(e):
+                    raise
+                raise exceptions.DuplicateEntry(str(e).split(': ')[-1], e)
 
     def delete(self, *objs):
-        for query, values in self._delete(*objs):
-            util.QUERY_LOGGER.debug("%s => %s" % (query, _todb(values)))
-            self.connection.execute(query, _todb(values))
-
-    def query(self, select):
-        table = self.session.connection.tables[select.classname]
+        for query, rows in self._delete(*objs):
+            self._executemany(query, rows)
 
-        columns = ["'%s'.'%s' AS '%s [%s]'" %
-                   (table.name, column.name, column.name,
-                    util.fullname_underscore(column.datatype.__class__))
-                   for (name, column) in table.columns.items()]
+    def _executemany(self, query, rows):
+        rows = (_todb(values) for values in rows)
+        for chunk in util.chunks(rows, self.backend.chunksize):
+            util.QUERY_LOGGER.debug("%s => %i rows", query, len(chunk))
+            self.connection.executemany(query, chunk)
 
-        query, values = self._query(select, columns=columns)
+    def query(self, select, track=True):
+        table = self.session.connection.tables[select.classname]
+        return self._results(table, select, self._compile,
+                             lambda values: values, track)
+
+    def execute(self, prepared, params):
+        table = self.session.connection.tables[prepared.classname]
+        compiled = prepared.compiled.get(self.backend)
+        if compiled is None or compiled[0] is not table:
+            compiled = (table, {})
+            prepared.compiled[self.backend] = compiled
+
+        def compile(select):
+            # The first page and the ones after it are compiled once each
+            shape = _queryshape(select, table)
+            if shape not in compiled[1]:
+                compiled[1][shape] = self._compile(select)
+            return compiled[1][shape]
+
+        return self._results(table, prepared.select, compile,
+                             lambda values: prepared.bindvalues(values,
+                                                                params))
+
+    def _results(self, table, select, compile, bind, track=True):
+        """
+        Yields the results of select, compiled by compile and with its values
+        bound by bind. Objects are read fetchsize rows at a time, each page
+        with a new query seeking past the last row of the one before (see
+        Select.after), so that the rows of objects committed while going
+        through them aren't read again. Records are read at once. Nothing is
+        added to the session unless track.
+        """
 
         try:
-            util.QUERY_LOGGER.debug("%s => %s" % (query, _todb(values)))
-            results = self.connection.execute(query, _todb(values))
+            if select.afterkey is not None:
+                select = select.copy().after(self._dbkey(table, select))
+
+            if select.projection:
+                query, joins = compile(select)
+                rows = self._select(query, bind(_parameters(select, table)))
+                for row in rows:
+                    yield self._createrecord(row, table, select)
+                return
+
+            limitclause = select.limitclause
+            start = limitclause and limitclause.start or 0
+            remaining = None
+            if limitclause and limitclause.end:
+                remaining = limitclause.end - start
+
+            key = select.afterkey
+            while remaining is None or remaining > 0:
+                size = self.backend.fetchsize
+                if remaining is not None:
+                    size = min(size, remaining)
+                    remaining -= size
+
+                page = select.copy().after(key)
+                page.limitclause = LimitClause(start, start + size)
+                query, joins = compile(page)
+                rows = self._select(query, bind(_parameters(page, table)))
+
+                # Only a page of rows is hydrated at a time, the objects of
+                # the pages before are found in the session
+                objs = self._hydrate(rows, table, select.constructor, {},
+                                     joins, track)
+                if select.prefetches:
+                    self.session.prefetch(objs, *select.prefetches,
+                                          track=track)
+                for obj in objs:
+                    yield obj
+
+                if len(rows) < size:
+                    break
+                start = 0
+                key = self._keyof(rows[-1], table, select)
 
-            for row in results:
-                obj = self._createobj(row, table, select.constructor)
-                yield obj
+        except sqlite3.OperationalError, e:
+            raise exceptions.TableDoesNotExist(table.name, e)
 
+    def _select(self, query, values):
+        util.QUERY_LOGGER.debug("%s => %s", query, values)
+        return self.connection.execute(query, _todb(values)).fetchall()
+
+    def _dbkey(self, table, select):
+        """
+        Returns the key of select (see Select.after) with the values of the
+        ordered fields as stored on the database, as the keys of the rows
+        read by _keyof are.
+        """
+
+        key = list(select.afterkey)
+        for index, orderbyclause in enumerate(select.orderbyclauses):
+            if index >= len(key) - 1:
+                break
+            column = table.columns.get(orderbyclause.field)
+            if column is not None and key[index] is not None:
+                key[index] = _todb(self.Wrapper(self, column, key[index]))
+        return tuple(key)
+
+    def _keyof(self, row, table, select):
+        """Returns the key of row in select as given to Select.after"""
+
+        return tuple([row[orderbyclause.field]
+                      for orderbyclause in select.orderbyclauses] +
+                     [table.hashkey.fromdb(table, row[_ID_FIELD_NAME])])
+
+    def _selectcolumns(self, table, joins):
+        columns = self._columns(table)
+        for name, target in joins:
+            columns.extend(self._columns(target, name))
+        return columns
+
+    def _columns(self, table, join=None):
+        """
+        Returns the columns selected for table. The columns of the table
+        joined for the One attribute join are named after it.
+        """
+
+        if join is None:
+            tablename, prefix = table.name, ''
+        else:
+            tablename, prefix = _JOIN_ALIAS % join, join + '.'
+
+        columns = ["'%s'.%s AS '%s%s'" % (tablename, _ID_FIELD_NAME, prefix,
+                                          _ID_FIELD_NAME)]
+        columns.extend(["'%s'.'%s' AS '%s%s [%s]'" %
+                        (tablename, column.name, prefix, column.name,
+                         util.fullname_underscore(column.datatype.__class__))
+                        for column in table.columns.values()])
+        return columns
+
+    def _hydrate(self, rows, table, constructor, loading, joins=(),
+                 track=True):
+        """
+        Creates the objects of rows along with the objects they point to.
+        The hash keys of the foreign keys are collected and the objects not
+        in the session or in loading are fetched with one query per table
+        and chunk, until nothing is left. Objects are put in loading before
+        their foreign keys are set, so cycles end up pointing to the same
+        instances. Lazy foreign keys load their targets into the session
+        unless track is False.
+        """
+
+        unresolved = {}
+        objs = [self._createobj(row, table, constructor, loading, unresolved,
+                                joins, track=track)
+                for row in rows]
+
+        while unresolved:
+            target, references = unresolved.popitem()
+
+            missing = [hashkey for hashkey in references
+                       if hashkey not in loading and hashkey not in
+                       self.session]
+            for row in self._fetch(target, missing):
+                self._createobj(row, target, target.class_, loading,
+                                unresolved, track=track)
+            for hashkey in missing:
+                # Dangling foreign keys aren't looked up again in this page
+                loading.setdefault(hashkey, None)
+
+            for hashkey, pointers in references.items():
+                if hashkey in loading:
+                    value = loading[hashkey]
+                elif hashkey in self.session:
+                    value = self.session[hashkey]
+                else:
+                    value = None
+                for obj, name in pointers:
+                    setattr(obj, name, value)
+
+        return objs
+
+    def _fetch(self, table, hashkeys):
+        """
+        Yields the rows of table with any of hashkeys, using one query per
+        chunk of hash keys.
+        """
+
+        columns = self._columns(table)
+        for chunk in util.chunks(hashkeys, min(self.backend.chunksize,
+                                               _MAXINVALUES)):
+            query = self._inquery(table, columns, len(chunk))
+            values = [table.hashkey.todb(hashkey) for hashkey in chunk]
+            util.QUERY_LOGGER.debug("%s => %s", query, values)
+            for row in self.connection.execute(query, _todb(values)):
+                yield row
+
+    def getmany(self, table, hashkeys):
+        loading = {}
+        try:
+            for rows in util.chunks(self._fetch(table, set(hashkeys)),
+                                    self.backend.chunksize):
+                self._hydrate(rows, table, table.class_, loading)
         except sqlite3.OperationalError, e:
             raise exceptions.TableDoesNotExist(table.name, e)
+        return [loading.get(hashkey) for hashkey in hashkeys]
+
+    def _createobj(self, row, table, constructor, loading, unresolved,
+                   joins=(), prefix='', track=True):
+        hashkey = table.hashkey.fromdb(table, row[prefix + _ID_FIELD_NAME])
+        if hashkey in loading:
+            return loading[hashkey]
 
-    def _createobj(self, row, table, constructor):
         obj = constructor()
+        loading[hashkey] = obj
+        joins = dict(joins)
         for name, column in table.columns.items():
             if isinstance(column.datatype, datatypes.One):
-                class_ = column.datatype.class_
-                value = self.session.get(class_, row[column.name])
-                setattr(obj, name, value)
-            elif isinstance(column.datatype, datatypes.Many):
-                # TODO: get collection or set proxy
-                value = []
-                setattr(obj, name, value)
+                target = self.session.gettable(class_=column.datatype.class_)
+                value = target.hashkey.fromdb(target,
+                                              row[prefix + column.name])
+                if value is None:
+                    setattr(obj, name, None)
+                elif (not column.datatype.autofetch and name not in joins and
+                      value not in self.session):
+                    setunloaded(obj, name, Unloaded(self.session,
+                                                    column.datatype.class_,
+                                                    value, track))
+                elif name in joins and value not in loading:
+                    if value in self.session:
+                        setattr(obj, name, self.session[value])
+                    elif row[name + '.' + _ID_FIELD_NAME] is None:
+                        setattr(obj, name, None)
+                    else:
+                        # The target's own foreign keys are batched
+                        setattr(obj, name,
+                                self._createobj(row, target, target.class_,
+                                                loading, unresolved,
+                                                prefix=name + '.',
+                                                track=track))
+                else:
+                    # Set once the objects of the whole page are loaded
+                    unresolved.setdefault(target, {}) \
+                              .setdefault(value, []).append((obj, name))
             else:
-                value = _fromdb(row[column.name], column)
+                value = _fromdb(row[prefix + column.name], column)
                 setattr(obj, name, value)
 
+        for name, column in table.foreignkeys.items():
+            if isinstance(column.datatype, datatypes.Many):
+                setattr(obj, name, Collection(self.session, obj, name))
+
         return obj
 
+    def _createrecord(self, row, table, select):
+        values = []
+        for item in select.projection:
+            if isinstance(item, (Count, Sum)):
+                values.append(row[item.name])
+                continue
+            elif isinstance(item, Aggregate):
+                name, column = item.name, table.columns[item.field]
+            else:
+                name, column = item, table.columns[item]
+
+            value = row[name]
+            if value is None:
+                values.append(None)
+            elif isinstance(column.datatype, datatypes.One):
+                target = self.session.gettable(class_=column.datatype.class_)
+                values.append(target.hashkey.fromdb(target, value))
+            else:
+                values.append(_fromdb(value, column))
+        return select.record()(*values)
+
+    def getcollections(self, table, name, objs):
+        target, inverse = self.getinverse(table, name)
+        column = target.columns[inverse]
+        columns = self._columns(target)
+
+        indexes = {}
+        for index, hashkey in enumerate(self.gethashkeys(objs)):
+            indexes.setdefault(hashkey, []).append(index)
+
+        # The objects already loaded don't need to be fetched again
+        loading = dict(zip(self.gethashkeys(objs), objs))
+        results = [[] for obj in objs]
+        for chunk in util.chunks(indexes.keys(), min(self.backend.chunksize,
+                                                     _MAXINVALUES)):
+            query = self._inquery(target, columns, len(chunk), column)
+            values = [table.hashkey.todb(hashkey) for hashkey in chunk]
+            util.QUERY_LOGGER.debug("%s => %s", query, values)
+            rows = self.connection.execute(query, _todb(values)).fetchall()
+
+            for row, value in zip(rows, self._hydrate(rows, target,
+                                                      target.class_,
+                                                      loading)):
+                hashkey = target.hashkey.fromdb(target, row[_ID_FIELD_NAME])
+                if hashkey in self.session:
+                    value = self.session[hashkey]
+                owner = table.hashkey.fromdb(table, row[column.name])
+                for index in indexes[owner]:
+                    results[index].append(value)
+
+        return results
+
     def commit(self):
         util.QUERY_LOGGER.debug("COMMIT")
         self.connection.commit()
@@ -166,5 +523,6 @@ class SQLiteConnectedBackend(StandardSQLConnectedBackend):
         self.connection.rollback()
 
     def disconnect(self):
-        self.connection
-        self.connection.close()
+        if self.connection is not None:
+            self.backend.pool.checkin(self.connection)
+            self.connection = None
@@ -20,23 +20,218 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from __future__ import with_statement
+
 __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
+import threading
+import weakref
+from collections import OrderedDict
+
 from .. import util
 from .. import exceptions
-from ..connection import Backend, ConnectedBackend
+from ..connection import Backend, ConnectedBackend, Unloaded
+from ..datatypes import ForeignKey, One
 from ..query import Select, CompareWhereClause, AndWhereClause, \
-                    OrWhereClause, Field
+                    OrWhereClause, InWhereClause, BetweenWhereClause, \
+                    LikeWhereClause, NullWhereClause, Field, Aggregate
 
 _ID_FIELD_NAME = '_cryo_id'
 
+# Name given in queries to the table joined for a One attribute
+_JOIN_ALIAS = "join_%s"
+
+# INSERT statements by table
+_insertqueries = weakref.WeakKeyDictionary()
+
+# Most values bound to an IN list, SQLite's default limit of host parameters
+_MAXINVALUES = 999
+
+
+def _shape(whereclause):
+    """
+    Returns what the SQL of whereclause depends on: its structure and fields
+    but not its values.
+    """
+
+    if whereclause is None:
+        return None
+    elif type(whereclause) is CompareWhereClause:
+        return (whereclause.comparator,
+                isinstance(whereclause.value1, Field) and
+                whereclause.value1.name,
+                isinstance(whereclause.value2, Field) and
+                whereclause.value2.name)
+    elif type(whereclause) in (AndWhereClause, OrWhereClause):
+        return (whereclause.__class__, _shape(whereclause.whereclause1),
+                _shape(whereclause.whereclause2))
+    elif type(whereclause) is InWhereClause:
+        return (whereclause.__class__, whereclause.field.name,
+                whereclause.values and _inlength(len(whereclause.values)))
+    elif type(whereclause) is NullWhereClause:
+        return (whereclause.__class__, whereclause.field.name,
+                whereclause.null)
+    elif type(whereclause) in (BetweenWhereClause, LikeWhereClause):
+        return (whereclause.__class__, whereclause.field.name)
+    else:
+        raise NotImplementedError(whereclause)
+
+
+def _queryshape(select, table):
+    """
+    Returns what the SQL of select depends on, so that queries of the same
+    shape share their compiled statement.
+    """
+
+    limitclause = select.limitclause
+    return (table, _shape(select.whereclause),
+            tuple([(orderbyclause.field, orderbyclause.ascending)
+                   for orderbyclause in select.orderbyclauses]),
+            limitclause and bool(limitclause.end),
+            tuple(select.joins),
+            tuple([isinstance(item, Aggregate) and item.shape() or item
+                   for item in select.projection]),
+            tuple(select.groupbys),
+            select.keyset,
+            select.afterkey is not None and
+            tuple([value is None for value in select.afterkey[:-1]]))
+
+
+def _inlength(count):
+    """
+    Returns how many values an IN list of count values binds: count rounded
+    up to a power of two, so lists of similar lengths share one statement.
+    """
+
+    length = 1
+    while length < count:
+        length *= 2
+    return min(length, _MAXINVALUES)
+
+
+def _invalues(whereclause):
+    """
+    Returns the values bound to the IN list of whereclause, padded to
+    _inlength by repeating the last one.
+    """
+
+    values = list(whereclause.values)
+    if len(values) > _MAXINVALUES:
+        raise exceptions.InvalidValue("Can't bind %i values to the IN list "
+                                      "of %s, at most %i" %
+                                      (len(values), whereclause.field.name,
+                                       _MAXINVALUES))
+    if values:
+        values.extend([values[-1]] * (_inlength(len(values)) - len(values)))
+    return values
+
+
+def _keysetvalues(select, table):
+    """
+    Returns the values bound to the condition of the rows after the key of
+    select, in the order given by _keyset.
+    """
+
+    key = select.afterkey
+    if len(key) != len(select.orderbyclauses) + 1:
+        raise ValueError("%s should have a value for each ordered field and "
+                         "the hash key" % (key, ))
+
+    values = []
+    for value in key[:-1]:
+        if value is not None:
+            values.extend((value, value))
+    values.append(table.hashkey.todb(key[-1]))
+    return values
+
+
+def _parameters(select, table):
+    """Returns the values bound to the SQL of select, in order"""
+
+    values = []
+    whereclauses = [select.whereclause]
+    while whereclauses:
+        whereclause = whereclauses.pop()
+        if whereclause is None:
+            continue
+        elif type(whereclause) is CompareWhereClause:
+            for value in (whereclause.value1, whereclause.value2):
+                if not isinstance(value, Field):
+                    values.append(value)
+        elif type(whereclause) is InWhereClause:
+            values.extend(_invalues(whereclause))
+        elif type(whereclause) is BetweenWhereClause:
+            values.extend((whereclause.low, whereclause.high))
+        elif type(whereclause) is LikeWhereClause:
+            values.append(whereclause.pattern)
+        elif type(whereclause) is NullWhereClause:
+            pass
+        else:
+            whereclauses.append(whereclause.whereclause2)
+            whereclauses.append(whereclause.whereclause1)
+
+    if select.afterkey is not None:
+        values.extend(_keysetvalues(select, table))
+
+    if select.limitclause:
+        values.append(select.limitclause.start)
+        if select.limitclause.end:
+            values.append(select.limitclause.end - select.limitclause.start)
+
+    return values
+
+
+class QueryCache(object):
+    """
+    SELECT statements compiled from queries, by the shape of the query. At
+    most size statements are kept, evicting the least recently used ones.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.queries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, shape, compiler):
+        with self._lock:
+            compiled = self.queries.pop(shape, None)
+            if compiled is not None:
+                self.queries[shape] = compiled
+                self.hits += 1
+                return compiled
+            self.misses += 1
+
+        compiled = compiler()
+        with self._lock:
+            self.queries.pop(shape, None)
+            while self.queries and len(self.queries) >= self.size:
+                self.queries.popitem(last=False)
+                self.evictions += 1
+            self.queries[shape] = compiled
+        return compiled
+
+    def clear(self):
+        with self._lock:
+            self.queries = OrderedDict()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self.queries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
 
 class StandardSQLBackend(Backend):
 
-    def __init__(self, uri, modules = None):
+    def __init__(self, uri, modules = None, querycachesize=256):
         Backend.__init__(self, uri, modules)
+        self.querycache = QueryCache(querycachesize)
 
 
 class StandardSQLConnectedBackend(ConnectedBackend):
@@ -44,50 +239,204 @@ class StandardSQLConnectedBackend(ConnectedBackend):
     def __init__(self, backend, session):
         ConnectedBackend.__init__(self, backend, session)
 
-    def _createtable(self, table):
-        columndefinitions = ["'%s' %s" %
-                             (column.name, self.gettype(column.datatype))
-                             for column in table.columns.values()]
-        return "CREATE TABLE '%s' (%s PRIMARY_KEY UNIQUE, %s)" % \
-                            (table.name, _ID_FIELD_NAME,
-                             ", ".join(columndefinitions))
+    def _createtable(self, table, options=''):
+        columndefinitions = ["%s %s PRIMARY KEY NOT NULL" %
+                             (_ID_FIELD_NAME, self._idtype(table))]
+        columndefinitions.extend(["'%s' %s" %
+                                  (column.name, self._columntype(column))
+                                  for column in table.columns.values()])
+        return "CREATE TABLE '%s' (%s)%s" % (table.name,
+                                             ", ".join(columndefinitions),
+                                             options)
+
+    def _idtype(self, table):
+        return self.gettype(table.hashkey.datatype)
+
+    def _createindex(self, table, index):
+        columns = ["'%s'" % table.columns[attr].name for attr in index.columns]
+        return "CREATE %sINDEX IF NOT EXISTS '%s' ON '%s' (%s)" % \
+                            (index.unique and "UNIQUE " or "", index.name,
+                             table.name, ", ".join(columns))
+
+    def _columntype(self, column):
+        datatype = column.datatype
+        if (isinstance(datatype, ForeignKey) and
+            datatype.classname in self.session.connection.tables):
+            # Foreign keys hold the hash key of the table they point to
+            datatype = self.session.connection.tables[datatype.classname] \
+                           .hashkey.datatype
+        return self.gettype(datatype)
 
     def gettype(self, datatype):
         raise NotImplementedError()
 
-    def _insert(self, *objs):
-        for obj in util.flatten(objs):
-            table = self.session.gettable(obj)
+    def getdbhashkey(self, obj):
+        """Returns the hash key of obj as stored on the database"""
 
-            names = [_ID_FIELD_NAME]
-            values = [self.gethashkey(obj)]
+        if isinstance(obj, Unloaded):
+            table = self.session.gettable(class_=obj.class_)
+            return table.hashkey.todb(obj.hashkey)
 
-            for name, column in table.columns.items():
-                names.append("'%s'" % column.name)
-                wrapped = self.Wrapper(self, column, getattr(obj, name))
-                values.append(wrapped)
+        table = self.session.gettable(obj)
+        return table.hashkey.todb(self.gethashkey(obj))
 
+    def _groupbytable(self, objs):
+        groups = []
+        tables = {}
+        for obj in util.flatten(objs):
+            table = self.session.gettable(obj)
+            if table.classname not in tables:
+                tables[table.classname] = []
+                groups.append((table, tables[table.classname]))
+            tables[table.classname].append(obj)
+        return groups
+
+    def _insertquery(self, table):
+        """
+        Returns the INSERT statement of table and the attributes whose values
+        go after the hash key, built once per table.
+        """
+
+        if table not in _insertqueries:
+            attributes = table.columns.keys()
+            names = [_ID_FIELD_NAME] + ["'%s'" % table.columns[attr].name
+                                        for attr in attributes]
             options = ', '.join(['?' for name in names])
 
-            query = ("INSERT OR REPLACE INTO '%s' (%s) VALUES (%s)"
-                     % (table.name, ", ".join(names), options))
+            if [index for index in table.indexes if index.unique]:
+                # REPLACE would silently delete the rows holding the same
+                # values on a unique index instead of failing
+                updates = ["%s = excluded.%s" % (name, name)
+                           for name in names[1:]]
+                query = ("INSERT INTO '%s' (%s) VALUES (%s) "
+                         "ON CONFLICT (%s) DO %s"
+                         % (table.name, ", ".join(names), options,
+                            _ID_FIELD_NAME, updates and
+                            "UPDATE SET " + ", ".join(updates) or "NOTHING"))
+            else:
+                query = ("INSERT OR REPLACE INTO '%s' (%s) VALUES (%s)"
+                         % (table.name, ", ".join(names), options))
 
-            yield query, values
+            _insertqueries[table] = (query, attributes)
+
+        return _insertqueries[table]
+
+    def _insert(self, *objs):
+        """
+        Yields the INSERT statement of each table along with an iterator over
+        the values of its objects.
+        """
+
+        for table, objs in self._groupbytable(objs):
+            query, attributes = self._insertquery(table)
+            yield query, self._insertvalues(table, attributes, objs)
+
+    def _insertvalues(self, table, attributes, objs):
+        columns = [table.columns[attr] for attr in attributes]
+        for obj, hashkey in zip(objs, self.gethashkeys(objs)):
+            values = [table.hashkey.todb(hashkey)]
+            for attr, column in zip(attributes, columns):
+                values.append(self.Wrapper(self, column,
+                                           self.getvalue(obj, attr)))
+            yield values
 
     def _delete(self, *objs):
-        for obj in util.flatten(objs):
-            table = self.session.gettable(obj)
+        """
+        Yields the DELETE statement of each table along with the hash keys of
+        its objects.
+        """
+
+        for table, objs in self._groupbytable(objs):
             query = "DELETE FROM '%s' WHERE %s = ?" % (table.name,
                                                        _ID_FIELD_NAME)
-            yield query, [self.gethashkey(obj)]
+            yield query, ([table.hashkey.todb(hashkey)]
+                          for hashkey in self.gethashkeys(objs))
 
     def get(self, table, hashkey):
         results = self.query(Select(table.class_).where(Field(_ID_FIELD_NAME),
-                                                        "=", hashkey))
+                                                        "=",
+                                                        table.hashkey
+                                                        .todb(hashkey)))
         for result in results:
             return result
 
-    def _query(self, query, columns=''):
+    def _joins(self, table, query):
+        """
+        Returns the One attributes of table whose targets are loaded in the
+        same statement, either for every query or just for query, along with
+        the tables they point to.
+        """
+
+        names = set(query.joins)
+        names.update([name for name, column in table.foreignkeys.items()
+                      if isinstance(column.datatype, One) and
+                      column.datatype.join])
+
+        joins = []
+        for name in sorted(names):
+            column = table.columns.get(name)
+            if column is None or not isinstance(column.datatype, One):
+                raise ValueError("%s is not a One attribute of %s"
+                                 % (name, table.name))
+            joins.append((name, self.session.gettable(
+                                    class_=column.datatype.class_)))
+        return joins
+
+    def _compile(self, select):
+        """
+        Returns the SELECT statement of select along with the joined
+        attributes, compiled once per query shape. The values to bind are
+        given by _parameters(select, table).
+        """
+
+        table = self.session.connection.tables[select.classname]
+
+        def compiler():
+            if select.projection:
+                columns = self._projectioncolumns(table, select.projection)
+                return self._query(select, columns)[0], []
+
+            joins = self._joins(table, select)
+            columns = self._selectcolumns(table, joins)
+            return self._query(select, columns, joins)[0], joins
+
+        return self.backend.querycache.get(_queryshape(select, table),
+                                           compiler)
+
+    def cachekey(self, select):
+        # The shape stands for the statement without compiling it again
+        table = self.session.connection.tables[select.classname]
+        key = (_queryshape(select, table), tuple(_parameters(select, table)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _selectcolumns(self, table, joins):
+        return ["'%s'.'%s'" % (table.name, column.name)
+                for column in table.columns.values()]
+
+    def _projectioncolumns(self, table, projection):
+        columns = []
+        for item in projection:
+            if not isinstance(item, Aggregate):
+                columns.append("%s AS '%s'" % (self._column(table, item),
+                                               item))
+            elif item.field is None:
+                columns.append("%s(*) AS '%s'" % (item.function, item.name))
+            else:
+                columns.append("%s(%s) AS '%s'" %
+                               (item.function,
+                                self._column(table, item.field), item.name))
+        return columns
+
+    def _column(self, table, name):
+        if name not in table.columns:
+            raise ValueError("%s is not a column of %s" % (name, table.name))
+        return "'%s'.'%s'" % (table.name, table.columns[name].name)
+
+    def _query(self, query, columns='', joins=()):
         table = self.session.connection.tables[query.classname]
 
         columns = columns or ["'%s'.'%s'" % (table.name, column.name)
@@ -97,29 +446,91 @@ class StandardSQLConnectedBackend(ConnectedBackend):
         queryparts.append("SELECT %s" % ", ".join(columns))
         queryparts.append("FROM '%s'" % table.name)
 
+        for name, target in joins:
+            queryparts.append("LEFT JOIN '%s' AS '%s' ON '%s'.%s = '%s'.'%s'"
+                              % (target.name, _JOIN_ALIAS % name,
+                                 _JOIN_ALIAS % name, _ID_FIELD_NAME,
+                                 table.name, table.columns[name].name))
+
+        wheres = []
         values = []
         if query.whereclause:
             where, values = self._where(table.name, query.whereclause)
-            queryparts.append("WHERE %s" % where)
+            wheres.append(where)
+        if query.afterkey is not None:
+            wheres.append(self._keyset(table, query))
+            values.extend(_keysetvalues(query, table))
+        if wheres:
+            queryparts.append("WHERE %s" % " AND ".join(wheres))
+
+        if query.groupbys:
+            queryparts.append("GROUP BY %s" %
+                              ", ".join([self._column(table, name)
+                                         for name in query.groupbys]))
+
+        if query.orderbyclauses or query.keyset:
+            # Aggregates are sorted by the name given to them
+            aggregates = set([item.name for item in query.projection
+                              if isinstance(item, Aggregate)])
 
-        if query.orderbyclauses:
             queryparts.append("ORDER BY")
             orderby = []
             for orderbyclause in query.orderbyclauses:
-                orderby.append("'%s'.'%s' %s" % (table.name,
-                                                 orderbyclause.field,
-                                                 orderbyclause.ascending
+                if orderbyclause.field in aggregates:
+                    field = "'%s'" % orderbyclause.field
+                else:
+                    field = "'%s'.'%s'" % (table.name, orderbyclause.field)
+                orderby.append("%s %s" % (field, orderbyclause.ascending
                                                  and "ASC" or "DESC"))
+            if query.keyset:
+                orderby.append("'%s'.%s ASC" % (table.name, _ID_FIELD_NAME))
             queryparts.append(", ".join(orderby))
 
         if query.limitclause:
-            queryparts .append("LIMIT %s" % query.limitclause.start)
+            queryparts.append("LIMIT ?")
+            values.append(query.limitclause.start)
             if query.limitclause.end:
-                queryparts.append(", %s" % (query.limitclause.end -
-                                            query.limitclause.start))
+                queryparts.append(", ?")
+                values.append(query.limitclause.end -
+                              query.limitclause.start)
 
         return " ".join(queryparts), values
 
+    def _keyset(self, table, query):
+        """
+        Returns the condition of the rows after query.afterkey. It is nested
+        so the first ordered field bounds the rows, which an index on it can
+        seek to. NULL comes before any value, as SQLite orders it.
+        """
+
+        condition = "'%s'.%s > ?" % (table.name, _ID_FIELD_NAME)
+        for orderbyclause, value in reversed(zip(query.orderbyclauses,
+                                                 query.afterkey)):
+            field = "'%s'.'%s'" % (table.name, orderbyclause.field)
+            if value is None and orderbyclause.ascending:
+                condition = "(%s IS NOT NULL OR %s)" % (field, condition)
+            elif value is None:
+                condition = "(%s IS NULL AND %s)" % (field, condition)
+            else:
+                comparator = orderbyclause.ascending and ">" or "<"
+                condition = "(%s %s= ? AND (%s %s ? OR %s))" % \
+                                (field, comparator, field, comparator,
+                                 condition)
+                if not orderbyclause.ascending:
+                    condition = "(%s IS NULL OR %s)" % (field, condition)
+        return condition
+
+    def _inquery(self, table, columns, count, column=None):
+        """
+        Returns the SELECT statement of the rows of table with any of count
+        hash keys, or any of count values of column.
+        """
+
+        field = column and "'%s'" % column.name or _ID_FIELD_NAME
+        return "SELECT %s FROM '%s' WHERE '%s'.%s IN (%s)" % \
+                            (", ".join(columns), table.name, table.name, field,
+                             ", ".join(["?"] * count))
+
     def _where(self, tablename, whereclause):
         if type(whereclause) is CompareWhereClause:
             query1, query2, values = self._value(tablename, whereclause.value1,
@@ -141,6 +552,30 @@ class StandardSQLConnectedBackend(ConnectedBackend):
             return "(%s OR %s)" % (whereclause1[0], whereclause2[0]), \
                    whereclause1[1] + whereclause2[1]
 
+        elif type(whereclause) is InWhereClause:
+            field = self._field(tablename, whereclause.field)
+            if not whereclause.values:
+                return "0 = 1", []
+            values = _invalues(whereclause)
+            return "%s IN (%s)" % (field, ", ".join(["?"] * len(values))), \
+                   values
+
+        elif type(whereclause) is BetweenWhereClause:
+            return "%s BETWEEN ? AND ?" % self._field(tablename,
+                                                      whereclause.field), \
+                   [whereclause.low, whereclause.high]
+
+        elif type(whereclause) is LikeWhereClause:
+            return "%s LIKE ? ESCAPE '%s'" % (self._field(tablename,
+                                                          whereclause.field),
+                                              LikeWhereClause.escape), \
+                   [whereclause.pattern]
+
+        elif type(whereclause) is NullWhereClause:
+            return "%s IS %sNULL" % (self._field(tablename, whereclause.field),
+                                     not whereclause.null and "NOT " or ""), \
+                   []
+
     def _value(self, tablename, value1, value2):
         values = []
 
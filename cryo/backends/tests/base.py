@@ -27,18 +27,51 @@ __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
 from datetime import datetime
+import pickle
 import random
 import math
 
+from cryo import util
+from cryo import exceptions
 from cryo.session import Session
-from cryo.query import (Select, Field, CompareWhereClause,
-                        AndWhereClause, OrWhereClause)
+from cryo.cache import ObjectCache
+from cryo.query import (Select, Field, Param, CompareWhereClause,
+                        AndWhereClause, OrWhereClause, InWhereClause,
+                        BetweenWhereClause, Count, Sum, Min, Max)
 
 from ...tests import testclasses
 from ...tests.testclasses import (CompleteTestClass, TestEnum,
                                   ForeignKeyTestClass,
                                   ForeignKeyTestClassOne,
-                                  ForeignKeyTestClassMany)
+                                  ForeignKeyTestClassMany,
+                                  IntegerKeyTestClass, DigestKeyTestClass,
+                                  CycleKeyTestClass, LazyTestClass,
+                                  PythonObjectKeyTestClass, IndexTestClass)
+
+
+def _track(connectedbackend, name, record):
+    """
+    Wraps the method name of connectedbackend so that each call adds what
+    record returns for its arguments to the list returned.
+    """
+
+    recorded = []
+    method = getattr(connectedbackend, name)
+
+    def tracking(*args, **kwargs):
+        recorded.extend(record(*args))
+        return method(*args, **kwargs)
+
+    setattr(connectedbackend, name, tracking)
+    return recorded
+
+
+def _trackinserts(session):
+    """Returns the list the objects session inserts are added to"""
+
+    return _track(session.connectedbackend, 'insert',
+                  lambda *objs: util.flatten(objs))
+
 
 
 class SessionTestCaseMixin:
@@ -99,6 +132,44 @@ class SessionTestCaseMixin:
 
             self.assertFalse(session.same(testobj1, testobj2))
 
+    def test_session_hashkey_cache(self):
+        with Session(self.connection) as session:
+            testobj = ForeignKeyTestClass('a')
+            testobj.one = None
+            hashkey = session.gethashkey(testobj)
+            fullhashkey = session.getfullhashkey(testobj)
+
+            computed = _track(session.connectedbackend, '_gethashkey',
+                              lambda obj, *args: [obj])
+
+            session.append(testobj)
+            self.assertEquals(session.gethashkey(testobj), hashkey)
+            self.assertEquals(session.getfullhashkey(testobj), fullhashkey)
+            self.assertEquals(computed, [])
+
+            testobj.one = ForeignKeyTestClassOne('b')
+            self.assertEquals(session.gethashkey(testobj), hashkey)
+            self.assertNotEquals(session.getfullhashkey(testobj), fullhashkey)
+            self.assertEquals(computed, [testobj, testobj.one])
+
+            testobj.name = 'c'
+            self.assertNotEquals(session.gethashkey(testobj), hashkey)
+            self.assertEquals(session.gethashkey(testobj),
+                              session.gethashkey(ForeignKeyTestClass('c')))
+
+    def test_session_hashkeys(self):
+        with Session(self.connection) as session:
+            testobj = ForeignKeyTestClass('a')
+            testobjs = [CompleteTestClass('1'), testobj, testobj.one,
+                        CompleteTestClass('2'), testobj]
+
+            hashkeys = session.gethashkeys(testobjs)
+
+            self.assertEquals(len(hashkeys), 5)
+            self.assertEquals(hashkeys[1], hashkeys[4])
+            for obj, hashkey in zip(testobjs, hashkeys):
+                self.assertEquals(hashkey, session.gethashkey(obj))
+
 
 class TransactionsTestCaseMixin:
 
@@ -131,6 +202,95 @@ class TransactionsTestCaseMixin:
             session.rollback()
             self.assertTrue(testobj in session)
 
+    def test_commit_only_dirty(self):
+        with Session(self.connection) as session:
+            for a in range(5):
+                session.append(CompleteTestClass(str(a)))
+
+        with Session(self.connection) as session:
+            inserted = _trackinserts(session)
+            testobjs = list(session.query(Select(CompleteTestClass)
+                                          .orderby('name')))
+            self.assertEquals(len(testobjs), 5)
+
+            session.commit()
+            self.assertEquals(inserted, [])
+
+            testobjs[1].integer = 42
+            testobjs[3].pythonobject.name = 'changed in place'
+            session.append(CompleteTestClass('new'))
+            session.commit()
+            self.assertEquals(sorted(obj.name for obj in inserted),
+                              ['1', '3', 'new'])
+
+            del inserted[:]
+            session.commit()
+            self.assertEquals(inserted, [])
+
+        with Session(self.connection) as session:
+            testobj_query = session.queryone(Select(CompleteTestClass)
+                                             .where(Field('name') == '1'))
+            self.assertEquals(testobj_query.integer, 42)
+
+    def test_commit_while_querying(self):
+        with Session(self.connection) as session:
+            for a in range(5):
+                session.append(CompleteTestClass(str(a)))
+        self.backend.fetchsize = 2
+
+        for select in (Select(CompleteTestClass).orderby('name'),
+                       Select(CompleteTestClass)):
+            with Session(self.connection) as session:
+                names = []
+                for testobj in session.query(select):
+                    names.append(testobj.name)
+                    testobj.integer += 1
+                    session.commit()
+                self.assertEquals(sorted(names), ['0', '1', '2', '3', '4'])
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals([obj.integer for obj in results], [3] * 5)
+
+    def test_commit_failed(self):
+        with Session(self.connection) as session:
+            session.append(CompleteTestClass('1'))
+            commit = session.connectedbackend.commit
+
+            def failingcommit():
+                session.connectedbackend.commit = commit
+                raise exceptions.DuplicateEntry("failed")
+
+            session.connectedbackend.commit = failingcommit
+            self.assertRaises(exceptions.DuplicateEntry, session.commit)
+
+            inserted = _trackinserts(session)
+            session.commit()
+            self.assertEquals([obj.name for obj in inserted], ['1'])
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals([obj.name for obj in results], ['1'])
+
+    def test_commit_batches(self):
+        with Session(self.connection) as session:
+            batches = _track(session.connectedbackend, 'insert',
+                             lambda *objs: [util.flatten(objs)])
+
+            testobj = ForeignKeyTestClass('a')
+            session.append(CompleteTestClass('1'),
+                           ForeignKeyTestClassMany('b', testobj),
+                           CompleteTestClass('2'), testobj, testobj.one)
+            session.commit()
+
+            classes = [batch[0].__class__ for batch in batches]
+            self.assertEquals(len(batches), 4)
+            self.assertEquals(sum(len(batch) for batch in batches), 5)
+            for batch in batches:
+                self.assertEquals(len(set(obj.__class__ for obj in batch)), 1)
+            self.assertTrue(classes.index(ForeignKeyTestClass) <
+                            classes.index(ForeignKeyTestClassMany))
+
 
 class DatatypesTestCaseMixin:
 
@@ -291,6 +451,415 @@ class ForeignKeyTestCaseMixin:
             results = session.query(Select(ForeignKeyTestClassMany))
             self.assertEquals(len(list(results)), 2)
 
+    def _fill_for_many(self, *names):
+        with Session(self.connection) as session:
+            for name in names:
+                testobj = ForeignKeyTestClass(name)
+                testobj.one = None
+                testobj.many = [ForeignKeyTestClassMany(name + str(a), testobj)
+                                for a in range(2)]
+                session.append(testobj, testobj.many)
+
+    def test_foreignkey_many_prefetch(self):
+        self._fill_for_many('a', 'b')
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(ForeignKeyTestClass)
+                                         .orderby('name')))
+            session.prefetch(results, 'many')
+            self.assertEquals([sorted([obj.name for obj in testobj.many])
+                               for testobj in results],
+                              [['a0', 'a1'], ['b0', 'b1']])
+            for testobj in results:
+                for obj in testobj.many:
+                    self.assertTrue(obj.one is testobj)
+
+    def test_foreignkey_many_prefetch_inverse(self):
+        with Session(self.connection) as session:
+            for name in ('a', 'b'):
+                testobj = ForeignKeyTestClass(name)
+                testobj.one = None
+                session.append(testobj,
+                               [ForeignKeyTestClassMany(name + str(a), testobj)
+                                for a in range(2)])
+
+        # The Many attributes are loaded from the objects pointing to them
+        with Session(self.connection) as session:
+            results = list(session.query(Select(ForeignKeyTestClass)
+                                         .orderby('name').prefetch('many')))
+            self.assertEquals([sorted([obj.name for obj in testobj.many])
+                               for testobj in results],
+                              [['a0', 'a1'], ['b0', 'b1']])
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(ForeignKeyTestClass)
+                                       .where(Field('name') == 'b'))
+            session.prefetch([testobj], 'many')
+            self.assertEquals(sorted([obj.name for obj in testobj.many]),
+                              ['b0', 'b1'])
+
+    def test_foreignkey_pickle(self):
+        self._fill_for_many('a')
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(ForeignKeyTestClass))
+            hashkey = session.gethashkey(testobj)
+            copy = pickle.loads(pickle.dumps(testobj, 2))
+            self.assertFalse('_cryo_hashkey' in copy.__dict__)
+            self.assertEquals(copy.name, 'a')
+            self.assertEquals(sorted([obj.name for obj in copy.many]),
+                              ['a0', 'a1'])
+            self.assertEquals(session.gethashkey(copy), hashkey)
+
+
+class HashKeyTestCaseMixin:
+
+    def test_hashkey_strategies(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            integerkey = IntegerKeyTestClass(5, 'five')
+            digestkey = DigestKeyTestClass('digest', integerkey)
+            session.append(integerkey, digestkey)
+
+            self.assertEquals(session.gethashkey(integerkey),
+                              ('IntegerKeyTestClass', 5))
+            self.assertEquals(len(session.gethashkey(digestkey)), 8)
+
+            hashkey = session.gethashkey(digestkey)
+
+        with Session(self.connection) as session:
+            digestkey = session.get(DigestKeyTestClass, hashkey)
+            self.assertEquals(digestkey.name, 'digest')
+            self.assertEquals(digestkey.integerkey.name, 'five')
+            self.assertEquals(session.gethashkey(digestkey), hashkey)
+
+    def _cycle(self, *names):
+        objs = [CycleKeyTestClass(name) for name in names]
+        for obj, other in zip(objs, objs[1:] + objs[:1]):
+            obj.other = other
+        return objs
+
+    def test_hashkey_cycle(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            a, b, c = self._cycle('a', 'b', 'c')
+            hashkeys = [session.gethashkey(obj) for obj in (a, b, c)]
+            self.assertEquals(len(set(hashkeys)), 3)
+
+            # The keys don't depend on which object is hashed first
+            a, b, c = self._cycle('a', 'b', 'c')
+            self.assertEquals(session.gethashkeys([c, b, a]),
+                              list(reversed(hashkeys)))
+            session.append(a, b, c)
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CycleKeyTestClass)))
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              ['a', 'b', 'c'])
+            for obj in results:
+                self.assertTrue(obj.other.other.other is obj)
+            self.assertEquals(sorted(session.gethashkeys(results)),
+                              sorted(hashkeys))
+
+    def test_hashkey_join(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            integerkey = IntegerKeyTestClass(1, 'one')
+            session.append(integerkey, DigestKeyTestClass('a', integerkey),
+                           DigestKeyTestClass('b', integerkey),
+                           DigestKeyTestClass('none'))
+            session.append(self._cycle('x', 'y'))
+
+        with Session(self.connection) as session:
+            results = dict((obj.name, obj) for obj in
+                           session.query(Select(DigestKeyTestClass)
+                                         .join('integerkey')))
+            self.assertEquals(results['a'].integerkey.name, 'one')
+            self.assertTrue(results['a'].integerkey is
+                            results['b'].integerkey)
+            self.assertTrue(results['none'].integerkey is None)
+
+            results = list(session.query(Select(CycleKeyTestClass)
+                                         .join('other')))
+            for obj in results:
+                self.assertTrue(obj.other.other is obj)
+
+    def test_hashkey_lazy(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            target = IntegerKeyTestClass(1, 'one')
+            session.append(target, LazyTestClass('lazy', target),
+                           LazyTestClass('none'))
+
+        with Session(self.connection) as session:
+            results = dict((obj.name, obj) for obj in
+                           session.query(Select(LazyTestClass)))
+            self.assertEquals(results['lazy'].target.name, 'one')
+            self.assertTrue(results['none'].target is None)
+            results['lazy'].name = 'renamed'
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(LazyTestClass)
+                                       .where(Field('name') == 'renamed'))
+            self.assertEquals(testobj.target.name, 'one')
+
+    def test_hashkey_pickle(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            target = IntegerKeyTestClass(1, 'one')
+            session.append(target, DigestKeyTestClass('digest', target),
+                           LazyTestClass('lazy', target))
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(DigestKeyTestClass))
+            hashkey = session.gethashkey(testobj)
+            copy = pickle.loads(pickle.dumps(testobj, 2))
+            self.assertEquals(copy.integerkey.name, 'one')
+            self.assertEquals(session.gethashkey(copy), hashkey)
+
+        with Session(self.connection) as session:
+            copy = pickle.loads(pickle.dumps(
+                        session.queryone(Select(LazyTestClass)), 2))
+            self.assertEquals(copy.name, 'lazy')
+
+    def test_hashkey_pythonobject(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            testobj = PythonObjectKeyTestClass('a', (1, 'b'))
+            table = session.gettable(testobj)
+            # Identities keep encoding python objects with str(), so the
+            # stored hash keys stay the same
+            self.assertEquals(session.gethashkey(testobj),
+                              table.hashkey.hashkey(table, ('a', (1, 'b')),
+                                                    ['a', "(1, 'b')"]))
+            session.append(testobj)
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(PythonObjectKeyTestClass))
+            self.assertEquals(testobj.value, (1, 'b'))
+
+    def test_hashkey_chain(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            objs = [CycleKeyTestClass('0')]
+            for a in range(1, 100):
+                objs.append(CycleKeyTestClass(str(a), objs[-1]))
+
+            computed = _track(session.connectedbackend, '_gethashkey',
+                              lambda obj, *args: [obj])
+
+            hashkeys = session.gethashkeys(reversed(objs))
+            self.assertEquals(len(set(hashkeys)), 100)
+            self.assertEquals(len(computed), 100)
+
+    def test_hashkey_invalidation(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            objs = [CycleKeyTestClass('0')]
+            for a in range(1, 10):
+                objs.append(CycleKeyTestClass(str(a), objs[-1]))
+            integerkey = IntegerKeyTestClass(1, 'one')
+            digestkey = DigestKeyTestClass('digest', integerkey)
+            hashkey = session.gethashkey(objs[-1])
+            fullhashkey = session.getfullhashkey(digestkey)
+
+            computed = _track(session.connectedbackend, '_gethashkey',
+                              lambda obj, *args: [obj])
+
+            # The keys of the chain don't depend on IntegerKeyTestClass
+            integerkey.id = 2
+            self.assertEquals(session.gethashkey(objs[-1]), hashkey)
+            self.assertNotEquals(session.getfullhashkey(digestkey),
+                                 fullhashkey)
+            self.assertEquals(computed, [digestkey, integerkey])
+
+            objs[0].name = 'changed'
+            self.assertNotEquals(session.gethashkey(objs[-1]), hashkey)
+
+    def test_hashkey_large(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            objs = [CycleKeyTestClass('0')]
+            for a in range(1, 10000):
+                objs.append(CycleKeyTestClass(str(a), objs[-1]))
+            self.assertEquals(len(set(session.gethashkeys(objs))), 10000)
+
+            cycle = self._cycle(*[str(a) for a in range(1000)])
+
+            computed = _track(session.connectedbackend, '_gethashkey',
+                              lambda obj, *args: [obj])
+
+            hashkeys = [session.gethashkey(obj) for obj in cycle]
+            self.assertEquals(len(set(hashkeys)), 1000)
+            # Each member is hashed once for the digest of the cycle and
+            # once for its own key
+            self.assertEquals(len(computed), 2000)
+
+            cycle = self._cycle(*[str(a) for a in range(1000)])
+            self.assertEquals(session.gethashkey(cycle[500]), hashkeys[500])
+
+
+class IndexTestCaseMixin:
+
+    def _fill_for_index(self):
+        self.connection.setup(testclasses.getindextables())
+
+        with Session(self.connection) as session:
+            for a in range(20):
+                session.append(IndexTestClass('name%i' % a, 'group%i' % (a % 2),
+                                              a, 'code%i' % a))
+
+    def test_index_query(self):
+        self._fill_for_index()
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(IndexTestClass)
+                                         .where((Field('group') == 'group1') &
+                                                (Field('number') == 7))))
+            self.assertEquals([obj.code for obj in results], ['code7'])
+
+            testobj = results[0]
+            testobj.number = 70
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(IndexTestClass)
+                                         .where(Field('number') == 7)))
+            self.assertEquals(results, [])
+            results = list(session.query(Select(IndexTestClass)
+                                         .where(Field('number') == 70)))
+            self.assertEquals([obj.code for obj in results], ['code7'])
+
+    def test_index_unique(self):
+        self._fill_for_index()
+
+        with Session(self.connection) as session:
+            session.append(IndexTestClass('other', 'group0', 0, 'code3'))
+            self.assertRaises(exceptions.DuplicateEntry, session.commit)
+            session.rollback()
+
+        with Session(self.connection) as session:
+            # None is never a duplicate and updating keeps the same entry
+            session.append(IndexTestClass('other0', 'group0', 0, None),
+                           IndexTestClass('other1', 'group0', 1, None))
+            testobj, = session.query(Select(IndexTestClass)
+                                     .where(Field('code') == 'code3'))
+            testobj.group = 'renamed'
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(IndexTestClass)
+                                         .where(Field('code') == 'code3')))
+            self.assertEquals([obj.group for obj in results], ['renamed'])
+            results = list(session.query(Select(IndexTestClass)))
+            self.assertEquals(len(results), 22)
+
+    def test_index_in(self):
+        self._fill_for_index()
+
+        with Session(self.connection) as session:
+            session.append(IndexTestClass('other', 'group0', 3, None))
+
+        with Session(self.connection) as session:
+            prepared = Select(IndexTestClass).where(Field('number').in_(
+                        [3, 5, 40, Param('number')])).orderby('name').prepare()
+            results = list(session.execute(prepared, number=7))
+            self.assertEquals([obj.name for obj in results],
+                              ['name3', 'name5', 'name7', 'other'])
+
+            results = list(session.query(Select(IndexTestClass)
+                                         .where(Field('code').isnull())))
+            self.assertEquals([obj.name for obj in results], ['other'])
+            results = list(session.query(Select(IndexTestClass)
+                                         .where(Field('code').notnull())))
+            self.assertEquals(len(results), 20)
+
+    def test_index_aggregates(self):
+        self._fill_for_index()
+
+        with Session(self.connection) as session:
+            session.append(IndexTestClass('other', 'group0', None, None))
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(IndexTestClass)
+                                         .columns(Count(), Count('code'),
+                                                  Sum('number'),
+                                                  Min(Field('number')),
+                                                  Max('number', 'last'))))
+            self.assertEquals(results, [(21, 20, 190, 0, 19)])
+            self.assertEquals(results[0].last, 19)
+
+            record, = session.query(Select(IndexTestClass)
+                                    .columns('name', Min('number', 'from'),
+                                             Max('number', '_max'), 'name')
+                                    .where(Field('number') == 3)
+                                    .groupby(Field('name')))
+            self.assertEquals(record, ('name3', 3, 3, 'name3'))
+            self.assertEquals((record.name, record._1, record._2, record._3),
+                              ('name3', 3, 3, 'name3'))
+
+            results = list(session.query(Select(IndexTestClass)
+                                         .columns(Count(), Sum('number'))
+                                         .where(Field('number') > 100)))
+            self.assertEquals(results, [(0, None)])
+
+            results = list(session.query(Select(IndexTestClass)
+                                         .columns('group', Count(),
+                                                  Sum('number'))
+                                         .groupby(Field('group'))
+                                         .orderby('sum_number')))
+            self.assertEquals(results, [('group0', 11, 90),
+                                        ('group1', 10, 100)])
+            self.assertEquals(len(session), 0)
+
+    def test_index_pages(self):
+        self._fill_for_index()
+
+        with Session(self.connection) as session:
+            pages = list(session.pages(Select(IndexTestClass)
+                                       .where(Field('number') >= 2)
+                                       .orderby('group', ('number', False)),
+                                       size=3))
+            self.assertEquals([len(page) for page in pages], [3] * 6)
+            self.assertEquals([obj.number for page in pages for obj in page],
+                              range(18, 1, -2) + range(19, 2, -2))
+
+            testobj = session.get(IndexTestClass, session.gethashkey(
+                                        IndexTestClass('name5', '', 0, '')))
+            key = session.keyof(testobj, Select(IndexTestClass)
+                                         .orderby('number'))
+            results = list(session.query(Select(IndexTestClass)
+                                         .orderby('number').after(key)[0:3]))
+            self.assertEquals([obj.number for obj in results], [6, 7, 8])
+
+            self.assertRaises(ValueError, list,
+                              session.query(Select(IndexTestClass)
+                                            .orderby('number').after((5, ))))
+
+        with Session(self.connection) as session:
+            session.append(IndexTestClass('null0', 'group0', None, None),
+                           IndexTestClass('null1', 'group1', None, None))
+
+        with Session(self.connection) as session:
+            pages = list(session.pages(Select(IndexTestClass)
+                                       .orderby('number'), size=4))
+            self.assertEquals([obj.number for page in pages for obj in page],
+                              [None, None] + range(20))
+            pages = list(session.pages(Select(IndexTestClass)
+                                       .orderby(('number', False)), size=4))
+            self.assertEquals([obj.number for page in pages for obj in page],
+                              range(19, -1, -1) + [None, None])
+            pages = list(session.pages(Select(IndexTestClass)
+                                       .orderby('number'), size=1))
+            self.assertEquals(len(pages), 22)
+
 
 class QueryTestCaseMixin:
 
@@ -312,6 +881,149 @@ class QueryTestCaseMixin:
             testobj_query = session.get(CompleteTestClass, hashkey)
             self.assertTrue(testobj_query is not None)
 
+    def test_getmany(self):
+        with Session(self.connection) as session:
+            testobjs = [CompleteTestClass(str(a)) for a in range(5)]
+            session.append(testobjs)
+            hashkeys = session.gethashkeys(testobjs)
+
+        with Session(self.connection) as session:
+            cached = session.get(CompleteTestClass, hashkeys[0])
+            session.append(cached)
+            results = session.getmany(CompleteTestClass,
+                                      hashkeys + ['missing', hashkeys[1]])
+            self.assertTrue(results[0] is cached)
+            self.assertEquals([obj and obj.name for obj in results],
+                              ['0', '1', '2', '3', '4', None, '1'])
+            self.assertTrue(results[1] is results[-1])
+
+    def test_objectcache(self):
+        objectcache = ObjectCache(ttls={'IntegerKeyTestClass': 0})
+        connection = self.backend.newconnection(objectcache=objectcache)
+        connection.setup(testclasses.gethashkeytables())
+
+        with Session(connection) as session:
+            integerkey = IntegerKeyTestClass(1, 'one')
+            testobj = DigestKeyTestClass('digest', integerkey)
+            session.append(testobj, integerkey)
+            hashkey = session.gethashkey(testobj)
+
+        with Session(connection) as session:
+            testobj = session.get(DigestKeyTestClass, hashkey)
+
+        with Session(connection) as session:
+            cached = session.get(DigestKeyTestClass, hashkey)
+            self.assertTrue(cached is not testobj)
+            self.assertEquals(cached.name, 'digest')
+            results = session.getmany(DigestKeyTestClass, [hashkey, 'missing'])
+            self.assertEquals([obj and obj.name for obj in results],
+                              ['digest', None])
+
+            # Cached when loaded, but it expires at once
+            self.assertEquals(cached.integerkey.name, 'one')
+            integerhashkey = session.gethashkey(cached.integerkey)
+
+        with Session(connection) as session:
+            integerkey = session.get(IntegerKeyTestClass, integerhashkey)
+            integerkey.name = 'changed'
+            session.append(integerkey)
+
+        stats = objectcache.stats()
+        self.assertEquals((stats['hits'], stats['expirations'],
+                           stats['invalidations']), (2, 1, 1))
+
+        with Session(connection) as session:
+            testobj = session.get(DigestKeyTestClass, hashkey)
+            self.assertEquals(testobj.integerkey.name, 'changed')
+        self.assertEquals(objectcache.stats()['hits'], 3)
+
+    def test_objectcache_connections(self):
+        objectcache = ObjectCache()
+        connections = [self.backend.newconnection(objectcache=objectcache)
+                       for a in range(2)]
+        for connection in connections:
+            connection.setup(testclasses.gethashkeytables())
+
+        with Session(connections[0]) as session:
+            session.append(IntegerKeyTestClass(1, 'one'))
+            hashkey = session.gethashkey(IntegerKeyTestClass(1))
+
+        for connection in connections * 2:
+            with Session(connection) as session:
+                testobj = session.get(IntegerKeyTestClass, hashkey)
+                self.assertEquals(testobj.name, 'one')
+        stats = objectcache.stats()
+        self.assertEquals((stats['hits'], stats['misses']), (3, 1))
+
+    def test_objectcache_generations(self):
+        objectcache = ObjectCache()
+        connection = self.backend.newconnection(objectcache=objectcache)
+        connection.setup(testclasses.gethashkeytables())
+        generation = objectcache.generation(connection.backend,
+                                            'IntegerKeyTestClass')
+
+        # Neither empty commits nor commits to other tables stop objects
+        # loaded before them from being cached
+        with Session(connection) as session:
+            pass
+        with Session(connection) as session:
+            session.append(LazyTestClass('other'))
+        self.assertEquals(objectcache.generation(connection.backend,
+                                                 'IntegerKeyTestClass'),
+                          generation)
+
+        with Session(connection) as session:
+            session.append(IntegerKeyTestClass(1, 'one'))
+        self.assertNotEquals(objectcache.generation(connection.backend,
+                                                    'IntegerKeyTestClass'),
+                             generation)
+
+    def test_objectcache_frozen(self):
+        objectcache = ObjectCache(size=1, frozen=True)
+        connection = self.backend.newconnection(objectcache=objectcache)
+        connection.setup(testclasses.gethashkeytables())
+
+        with Session(connection) as session:
+            session.append([IntegerKeyTestClass(a) for a in range(2)])
+            hashkeys = session.gethashkeys([IntegerKeyTestClass(a)
+                                            for a in range(2)])
+
+        frozen = []
+        for a in range(3):
+            with Session(connection) as session:
+                frozen.append(session.get(IntegerKeyTestClass, hashkeys[0]))
+        self.assertTrue(frozen[0] is not frozen[1])
+        self.assertTrue(frozen[1] is frozen[2])
+        self.assertRaises(exceptions.Frozen, setattr, frozen[1], 'name', '')
+
+        with Session(connection) as session:
+            session.get(IntegerKeyTestClass, hashkeys[1])
+            self.assertTrue(session.get(IntegerKeyTestClass, hashkeys[0])
+                            is not frozen[1])
+        self.assertEquals(objectcache.stats()['evictions'], 2)
+
+    def test_prepared(self):
+        self._fill_for_query()
+
+        select = Select(CompleteTestClass).where(Field('name') == Param('name'))
+        prepared = select.prepare()
+        select.and_(Field('name') != '1')
+
+        with Session(self.connection) as session:
+            for a in range(3):
+                results = list(session.execute(prepared, name=str(a)))
+                self.assertEquals([obj.name for obj in results], [str(a)])
+            self.assertRaises(ValueError, list, session.execute(prepared))
+
+        self._fill_for_index()
+        prepared = Select(IndexTestClass).where((Field('number') >= 0) &
+                                                (Field('group') ==
+                                                 Param('group'))).prepare()
+
+        with Session(self.connection) as session:
+            results = list(session.execute(prepared, group='group1'))
+            self.assertEquals(len(results), 10)
+
     def test_query_where_full(self):
         self._fill_for_query()
 
@@ -336,6 +1048,17 @@ class QueryTestCaseMixin:
         self.assertTrue(isinstance(Field('a') == Field('b'),
                                    CompareWhereClause))
 
+        # Clauses over a single field
+        self.assertTrue(isinstance(Field('a').in_([0, 1]), InWhereClause))
+        self.assertTrue(isinstance(Field('a').between(0, 1),
+                                   BetweenWhereClause))
+        self.assertTrue(isinstance(Field('a').startswith('1%_'),
+                                   AndWhereClause))
+        self.assertTrue(isinstance(Field('a').startswith('\xff'),
+                                   CompareWhereClause))
+        self.assertTrue(Field('a').isnull().null)
+        self.assertFalse(Field('a').notnull().null)
+
     def test_query_fieldcomparison(self):
         self._fill_for_query()
 
@@ -392,6 +1115,126 @@ class QueryTestCaseMixin:
 
             self.assertEquals(len(results), 1)
 
+    def test_query_in(self):
+        self._fill_for_query()
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)
+                                         .where(Field('name')
+                                                .in_(['1', '3', 30]))
+                                         .orderby('name')))
+            self.assertEquals([obj.name for obj in results], ['1', '3'])
+
+            results = list(session.query(Select(CompleteTestClass)
+                                         .where(Field('name').in_([]))))
+            self.assertEquals(results, [])
+
+    def test_query_between(self):
+        self._fill_for_query()
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)
+                                         .where(Field('name')
+                                                .between('3', '5'))
+                                         .orderby('name')))
+            self.assertEquals([obj.name for obj in results], ['3', '4', '5'])
+
+    def test_query_like(self):
+        with Session(self.connection) as session:
+            for name in ['abc', 'ABD', 'a_c', 'a%c', 'xabc']:
+                session.append(CompleteTestClass(name))
+
+        with Session(self.connection) as session:
+            def names(where):
+                return sorted([obj.name for obj in session.query(
+                                    Select(CompleteTestClass).where(where))])
+
+            self.assertEquals(names(Field('name').like('a_c')),
+                              ['a%c', 'a_c', 'abc'])
+            self.assertEquals(names(Field('name').like('%b%')),
+                              ['ABD', 'abc', 'xabc'])
+            self.assertEquals(names(Field('name').startswith('a_')), ['a_c'])
+            # Unlike LIKE, case matters
+            self.assertEquals(names(Field('name').startswith('ab')), ['abc'])
+            self.assertEquals(names(Field('name').startswith('AB')), ['ABD'])
+            self.assertEquals(names(Field('name').startswith('')),
+                              ['ABD', 'a%c', 'a_c', 'abc', 'xabc'])
+
+    def test_query_columns(self):
+        self._fill_for_query()
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)
+                                         .columns(Field('name'), 'integer')
+                                         .where(Field('name') < '3')
+                                         .orderby('name')))
+            self.assertEquals(results, [('0', 1), ('1', 1), ('2', 1)])
+            self.assertEquals([record.name for record in results],
+                              ['0', '1', '2'])
+            self.assertEquals(len(session), 0)
+
+            self.assertRaises(ValueError, list,
+                              session.query(Select(CompleteTestClass)
+                                            .columns('missing')))
+
+        with Session(self.connection) as session:
+            testobj = ForeignKeyTestClass('a')
+            session.append(testobj)
+            hashkey = session.gethashkey(testobj.one)
+
+        with Session(self.connection) as session:
+            record, = session.query(Select(ForeignKeyTestClass)
+                                    .columns('one', 'name'))
+            self.assertEquals(record, (hashkey, 'a'))
+            self.assertEquals(len(session), 0)
+
+    def test_query_untracked(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            for a in range(3):
+                testobj = DigestKeyTestClass(str(a), IntegerKeyTestClass(a))
+                session.append(testobj, testobj.integerkey)
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(DigestKeyTestClass)
+                                         .orderby('name'), track=False))
+            self.assertEquals([obj.name for obj in results], ['0', '1', '2'])
+            self.assertEquals([obj.integerkey.id for obj in results],
+                              [0, 1, 2])
+            self.assertEquals(len(session), 0)
+
+            testobj = session.queryone(Select(DigestKeyTestClass),
+                                       track=False)
+            self.assertTrue(testobj is not None)
+            self.assertEquals(len(session), 0)
+
+    def test_query_untracked_loads(self):
+        self.connection.setup(testclasses.gethashkeytables())
+        self._fill_for_many('a', 'b')
+
+        with Session(self.connection) as session:
+            for a in range(3):
+                testobj = LazyTestClass(str(a), IntegerKeyTestClass(a))
+                session.append(testobj, testobj.target)
+
+        with Session(self.connection) as session:
+            inserted = _trackinserts(session)
+
+            # Neither the prefetched objects nor the lazy ones are added
+            results = list(session.query(Select(ForeignKeyTestClass)
+                                         .prefetch('many'), track=False))
+            self.assertEquals([len(testobj.many) for testobj in results],
+                              [2, 2])
+            results = list(session.query(Select(LazyTestClass)
+                                         .orderby('name'), track=False))
+            self.assertEquals([testobj.target.id for testobj in results],
+                              [0, 1, 2])
+            self.assertEquals(len(session), 0)
+
+            session.commit()
+            self.assertEquals(inserted, [])
+
     def test_query_limit(self):
         self._fill_for_query()
 
@@ -411,9 +1254,37 @@ class QueryTestCaseMixin:
             for a in range(10):
                 self.assertEquals(results[a].name, str(a))
 
+    def test_query_pages_converted(self):
+        enums = [TestEnum.first, TestEnum.second, TestEnum.third]
+        with Session(self.connection) as session:
+            for a in range(7):
+                testobj = CompleteTestClass(str(a))
+                testobj.enum = enums[a % 3]
+                session.append(testobj)
+
+                testobj = ForeignKeyTestClass(str(a))
+                testobj.one.name = str(a)
+                session.append(testobj, testobj.one)
+
+        with Session(self.connection) as session:
+            pages = list(session.pages(Select(CompleteTestClass)
+                                       .orderby('enum'), size=2))
+            results = [obj for page in pages for obj in page]
+            self.assertEquals([obj.enum for obj in results],
+                              sorted([enums[a % 3] for a in range(7)]))
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              [str(a) for a in range(7)])
+
+            pages = list(session.pages(Select(ForeignKeyTestClass)
+                                       .orderby('one'), size=2))
+            self.assertEquals(sorted([obj.name for page in pages
+                                      for obj in page]),
+                              [str(a) for a in range(7)])
+
 
 class BackendTestCaseMixin(SessionTestCaseMixin, TransactionsTestCaseMixin,
                            DatatypesTestCaseMixin, ForeignKeyTestCaseMixin,
+                           HashKeyTestCaseMixin, IndexTestCaseMixin,
                            QueryTestCaseMixin):
 
     def _setUp(self, backend):
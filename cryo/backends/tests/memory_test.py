@@ -27,6 +27,9 @@ __version__ = "$Revision$"[11:-2]
 import unittest
 
 from cryo.backends.memory import MemoryBackend
+from cryo.collection import Collection
+from cryo.query import Select
+from cryo.session import Session
 
 from .base import BackendTestCaseMixin
 from ...tests import testclasses
@@ -36,3 +39,35 @@ class MemoryBackendTestCase(unittest.TestCase, BackendTestCaseMixin):
 
     def setUp(self):
         self._setUp(MemoryBackend())
+
+    def test_get_integerkey(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            session.append(testclasses.IntegerKeyTestClass(5, 'five'))
+
+        with Session(self.connection) as session:
+            testobj = session.get(testclasses.IntegerKeyTestClass,
+                                  ('IntegerKeyTestClass', 5))
+            self.assertEquals(testobj.name, 'five')
+
+    def test_prefetch_shared(self):
+        self._fill_for_many('a')
+
+        for a in range(2):
+            with Session(self.connection) as session:
+                testobj = session.queryone(Select(
+                                            testclasses.ForeignKeyTestClass))
+                session.prefetch([testobj], 'many')
+                self.assertFalse(isinstance(testobj.many, Collection))
+                self.assertEquals(sorted([obj.name for obj in testobj.many]),
+                                  ['a0', 'a1'])
+
+    def test_query_untracked_values(self):
+        self._fill_for_many('a')
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(
+                                testclasses.ForeignKeyTestClass), track=False))
+            self.assertEquals(len(results), 1)
+            self.assertEquals(session.connectedbackend._values, {})
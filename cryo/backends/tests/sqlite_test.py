@@ -20,17 +20,58 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from __future__ import with_statement
+
 __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
+import pickle
 import unittest
 import tempfile
+import sqlite3
+from contextlib import contextmanager
 
+from cryo import exceptions
 from cryo.backends.sqlite import SQLiteBackend
+from cryo.backends.standardsql import QueryCache
+from cryo.session import Session
+from cryo.query import Select, Field, Param, Count
+from cryo.collection import Collection
+from cryo.cache import ResultCache
 
-from .base import BackendTestCaseMixin
+from .base import BackendTestCaseMixin, _trackinserts
 from ...tests import testclasses
+from ...tests.testclasses import CompleteTestClass, IntegerKeyTestClass, \
+                                 DigestKeyTestClass, LazyTestClass, \
+                                 ForeignKeyTestClass, ForeignKeyTestClassMany
+
+
+class CountingConnection(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = []
+
+    def execute(self, query, *args):
+        self.queries.append(query)
+        return self.connection.execute(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+@contextmanager
+def _countqueries(session):
+    """Yields the list of the queries session runs within the block"""
+
+    connectedbackend = session.connectedbackend
+    connection = connectedbackend.connection
+    connectedbackend.connection = CountingConnection(connection)
+    try:
+        yield connectedbackend.connection.queries
+    finally:
+        connectedbackend.connection = connection
 
 
 class SQLiteBackendTestCase(unittest.TestCase, BackendTestCaseMixin):
@@ -38,3 +79,458 @@ class SQLiteBackendTestCase(unittest.TestCase, BackendTestCaseMixin):
     def setUp(self):
         filename = tempfile.mktemp()
         self._setUp(SQLiteBackend(filename, modules=[testclasses]))
+
+    def test_insert_delete_chunks(self):
+        self.backend.chunksize = 2
+
+        with Session(self.connection) as session:
+            for a in range(5):
+                session.append(CompleteTestClass(str(a)))
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals(len(results), 5)
+            for testobj in results[:3]:
+                del session[testobj]
+
+        with Session(self.connection) as session:
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals(len(results), 2)
+
+    def test_query_foreignkeys_batched(self):
+        self.connection.setup(testclasses.gethashkeytables())
+        self.backend.chunksize = 4
+
+        with Session(self.connection) as session:
+            targets = [IntegerKeyTestClass(a, str(a)) for a in range(3)]
+            session.append(targets)
+            for a in range(10):
+                session.append(DigestKeyTestClass(str(a), targets[a % 3]))
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(DigestKeyTestClass)))
+
+            # One query for the results and one for the first page's targets,
+            # the later pages find them already loaded
+            self.assertEquals(len(queries), 2)
+            self.assertTrue(" IN (?, ?, ?)" in queries[1])
+            self.assertEquals(len(results), 10)
+            targets = dict((obj.name, obj.integerkey) for obj in results)
+            self.assertTrue(targets['0'] is targets['3'] is targets['9'])
+            self.assertEquals(targets['4'].name, '1')
+
+    def test_query_join(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            targets = [IntegerKeyTestClass(a, str(a)) for a in range(3)]
+            session.append(targets)
+            for a in range(10):
+                session.append(DigestKeyTestClass(str(a), targets[a % 3]))
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(DigestKeyTestClass)
+                                             .join('integerkey')))
+
+            self.assertEquals(len(queries), 1)
+            self.assertTrue("LEFT JOIN 'IntegerKeyTestClass'" in queries[0])
+            targets = dict((obj.name, obj.integerkey) for obj in results)
+            self.assertTrue(targets['0'] is targets['3'] is targets['9'])
+            self.assertEquals(targets['4'].name, '1')
+
+            self.assertRaises(ValueError, list,
+                              session.query(Select(DigestKeyTestClass)
+                                            .join('name')))
+
+    def test_query_lazy(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            target = IntegerKeyTestClass(1, 'one')
+            other = IntegerKeyTestClass(2, 'two')
+            session.append(target, other, LazyTestClass('a', target),
+                           LazyTestClass('b', target),
+                           LazyTestClass('c', other))
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(LazyTestClass)
+                                             .orderby('name')))
+                self.assertEquals(len(queries), 1)
+
+                # Hashing and committing don't load the target
+                hashkey = session.gethashkey(results[0])
+                session.commit()
+                self.assertEquals(len(queries), 1)
+                self.assertTrue('target' not in results[0].__dict__)
+
+                self.assertEquals(results[0].target.name, 'one')
+                self.assertEquals(len(queries), 2)
+                self.assertTrue(results[0].target is results[1].target)
+                self.assertEquals(len(queries), 2)
+                self.assertEquals(session.gethashkey(results[0]), hashkey)
+
+        self.assertRaises(exceptions.SessionClosed, getattr, results[2],
+                          'target')
+
+        # Copies aren't bound to the session either
+        copy = pickle.loads(pickle.dumps(results[2], 2))
+        self.assertRaises(exceptions.SessionClosed, getattr, copy, 'target')
+
+    def test_many_lazy(self):
+        self._fill_for_many('a')
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                testobj = session.queryone(Select(ForeignKeyTestClass))
+                self.assertTrue(isinstance(testobj.many, Collection))
+                self.assertFalse(testobj.many.loaded)
+                self.assertEquals(len(queries), 1)
+
+                self.assertEquals(sorted([obj.name for obj in testobj.many]),
+                                  ['a0', 'a1'])
+                self.assertEquals(len(queries), 2)
+                self.assertEquals(len(session), 3)
+
+    def test_many_delta(self):
+        self._fill_for_many('a')
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(ForeignKeyTestClass))
+            removed = [obj for obj in testobj.many if obj.name == 'a0'][0]
+            testobj.many.remove(removed)
+            added = ForeignKeyTestClassMany('a2', testobj)
+            added.one = None
+            testobj.many.append(added)
+
+            inserted = _trackinserts(session)
+            session.commit()
+            self.assertEquals(sorted([obj.name for obj in inserted]),
+                              ['a0', 'a2'])
+            self.assertTrue(removed.one is None)
+            self.assertTrue(added.one is testobj)
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(ForeignKeyTestClass))
+            self.assertEquals(sorted([obj.name for obj in testobj.many]),
+                              ['a1', 'a2'])
+            orphan = session.queryone(Select(ForeignKeyTestClassMany)
+                                      .where(Field('name') == 'a0'))
+            self.assertTrue(orphan.one is None)
+
+    def test_many_rollback(self):
+        self._fill_for_many('a')
+
+        with Session(self.connection) as session:
+            testobj = session.queryone(Select(ForeignKeyTestClass))
+            testobj.many.pop()
+            self.assertEquals(len(testobj.many), 1)
+            session.rollback()
+            self.assertEquals(len(testobj.many), 2)
+
+    def test_many_prefetch_query(self):
+        self._fill_for_many('a', 'b', 'c')
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(ForeignKeyTestClass)
+                                             .prefetch('many')))
+                self.assertEquals(len(queries), 2)
+                self.assertEquals(sum([len(obj.many) for obj in results]), 6)
+                self.assertEquals(len(queries), 2)
+
+    def test_getmany_chunks(self):
+        self.backend.chunksize = 2
+
+        with Session(self.connection) as session:
+            testobjs = [CompleteTestClass(str(a)) for a in range(5)]
+            session.append(testobjs)
+            hashkeys = session.gethashkeys(testobjs)
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = session.getmany(CompleteTestClass, hashkeys)
+
+            self.assertEquals(len(queries), 3)
+            self.assertEquals([obj.name for obj in results],
+                              ['0', '1', '2', '3', '4'])
+
+    def test_querycache(self):
+        self._fill_for_query()
+        self.backend.querycache.clear()
+        stats = self.backend.querycache.stats()
+
+        with Session(self.connection) as session:
+            for a in range(5):
+                results = list(session.query(Select(CompleteTestClass)
+                                             .where(Field('name') == str(a))
+                                             [0:5]))
+                self.assertEquals([obj.name for obj in results], [str(a)])
+
+            results = list(session.query(Select(CompleteTestClass)
+                                         .where(Field('name') > '7')))
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              ['8', '9'])
+
+        newstats = self.backend.querycache.stats()
+        self.assertEquals(newstats['size'], 2)
+        self.assertEquals(newstats['misses'], stats['misses'] + 2)
+        self.assertEquals(newstats['hits'], stats['hits'] + 4)
+
+    def test_querycache_lru(self):
+        querycache = QueryCache(2)
+        for shape in ('a', 'b', 'a', 'c', 'a'):
+            querycache.get(shape, lambda: shape.upper())
+
+        self.assertEquals(querycache.queries.keys(), ['c', 'a'])
+        self.assertEquals(querycache.stats(), {'size': 2, 'hits': 2,
+                                               'misses': 3, 'evictions': 1})
+
+    def test_query_in_bounded(self):
+        self._fill_for_query()
+        self.backend.querycache.clear()
+
+        with Session(self.connection) as session:
+            for names in (['1', '2', '3'], ['4', '5', '6', '7'], ['8']):
+                results = list(session.query(Select(CompleteTestClass)
+                                             .where(Field('name')
+                                                    .in_(names))))
+                self.assertEquals(sorted([obj.name for obj in results]),
+                                  names)
+            # Lists of 3 and 4 values share a statement
+            self.assertEquals(self.backend.querycache.stats()['size'], 2)
+
+            self.assertRaises(exceptions.InvalidValue, list,
+                              session.query(Select(CompleteTestClass)
+                                            .where(Field('name')
+                                                   .in_(range(1000)))))
+
+    def test_getmany_bounded(self):
+        backend = SQLiteBackend(tempfile.mktemp(), modules=[testclasses],
+                                chunksize=2000)
+        connection = backend.newconnection()
+        connection.setup(testclasses.gettables())
+
+        with Session(connection) as session:
+            session.append(CompleteTestClass('a'))
+            hashkey = session.gethashkey(CompleteTestClass('a'))
+
+        with Session(connection) as session:
+            hashkeys = [str(a) for a in range(1500)] + [hashkey]
+            results = session.getmany(CompleteTestClass, hashkeys)
+            self.assertEquals([obj.name for obj in results if obj], ['a'])
+
+    def test_query_streams(self):
+        self._fill_for_query()
+        self.backend.fetchsize = 3
+        created = []
+
+        def constructor():
+            created.append(True)
+            return CompleteTestClass()
+
+        with Session(self.connection) as session:
+            results = session.query(Select(CompleteTestClass, constructor))
+            results.next()
+            self.assertEquals(len(created), 3)
+            self.assertEquals(len(list(results)), 9)
+            self.assertEquals(len(created), 10)
+
+    def test_query_columns_only(self):
+        self._fill_for_query()
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(CompleteTestClass)
+                                             .columns('name')))
+                query, = queries
+
+        self.assertEquals(len(results), 10)
+        self.assertTrue("'longtext'" not in query)
+        self.assertTrue("'pythonobject'" not in query)
+
+    def test_query_aggregates_pushed_down(self):
+        self._fill_for_query()
+
+        with Session(self.connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(Select(CompleteTestClass)
+                                             .columns('integer', Count())
+                                             .groupby('integer')))
+                query, = queries
+
+        self.assertEquals(results, [(1, 10)])
+        self.assertTrue("COUNT(*)" in query)
+        self.assertTrue("GROUP BY 'CompleteTestClass'.'integer'" in query)
+
+    def test_resultcache(self):
+        self._fill_for_query()
+        connection = self.backend.newconnection(ResultCache())
+        connection.setup(testclasses.gettables())
+        select = lambda: Select(CompleteTestClass).where(Field('name') > '7')
+        self.backend.querycache.clear()
+        querystats = self.backend.querycache.stats()
+
+        with Session(connection) as session:
+            results = list(session.query(select()))
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              ['8', '9'])
+            records = list(session.query(select().columns('name')))
+
+        with Session(connection) as session:
+            with _countqueries(session) as queries:
+                results = list(session.query(select()))
+                self.assertEquals(list(session.query(select()
+                                                     .columns('name'))),
+                                  records)
+
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              ['8', '9'])
+            self.assertEquals(len(session), 2)
+            # Just the objects are loaded by their hash keys
+            self.assertEquals(len(queries), 1)
+            self.assertTrue(" IN " in queries[0])
+
+            session.append(CompleteTestClass('x'))
+
+        with Session(connection) as session:
+            results = list(session.query(select()))
+            self.assertEquals(sorted([obj.name for obj in results]),
+                              ['8', '9', 'x'])
+
+        stats = connection.resultcache.stats()
+        self.assertEquals((stats['hits'], stats['misses'],
+                           stats['invalidations']), (2, 3, 2))
+        # Each query run looks its statement up once, cached results don't
+        newstats = self.backend.querycache.stats()
+        self.assertEquals((newstats['hits'] - querystats['hits'],
+                           newstats['misses'] - querystats['misses']), (1, 2))
+
+    def test_prepared_compiled_once(self):
+        self._fill_for_query()
+        prepared = Select(CompleteTestClass).where(Field('name') ==
+                                                   Param('name')).prepare()
+
+        with Session(self.connection) as session:
+            list(session.execute(prepared, name='1'))
+            stats = self.backend.querycache.stats()
+            for a in range(5):
+                results = list(session.execute(prepared, name=str(a)))
+                self.assertEquals([obj.name for obj in results], [str(a)])
+
+        self.assertEquals(self.backend.querycache.stats(), stats)
+        self.assertTrue(self.backend in prepared.compiled)
+
+    def test_pool(self):
+        stats = self.backend.pool.stats()
+
+        with Session(self.connection, autocommit=False) as session:
+            connection = session.connectedbackend.connection
+            self.assertEquals(self.backend.pool.stats()['inuse'], 1)
+            session.append(CompleteTestClass('pooled'))
+            session.commit()
+            # Left uncommitted, rolled back when the connection is returned
+            session.connectedbackend.insert(CompleteTestClass('rolled back'))
+
+        with Session(self.connection) as session:
+            self.assertTrue(session.connectedbackend.connection is connection)
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals([obj.name for obj in results], ['pooled'])
+
+        newstats = self.backend.pool.stats()
+        self.assertEquals(newstats['opened'], stats['opened'])
+        self.assertEquals(newstats['inuse'], 0)
+        self.assertEquals(newstats['checkouts'], stats['checkouts'] + 2)
+
+    def test_pool_timeout(self):
+        backend = SQLiteBackend(tempfile.mktemp(), modules=[testclasses],
+                                poolsize=1, pooltimeout=0.01)
+        connection = backend.newconnection()
+        connection.setup(testclasses.gettables())
+
+        with Session(connection) as session:
+            self.assertRaises(exceptions.PoolTimeout, Session, connection)
+
+        stats = backend.pool.stats()
+        self.assertEquals(stats['opened'], 1)
+        self.assertEquals(stats['waits'], 1)
+        self.assertTrue(stats['waittime'] > 0)
+
+    def test_pool_unbounded(self):
+        sessions = [Session(self.connection) for a in range(10)]
+        self.assertEquals(self.backend.pool.stats()['inuse'], 10)
+        for session in sessions:
+            session.__exit__(None, None, None)
+
+        stats = self.backend.pool.stats()
+        self.assertEquals((stats['inuse'], stats['waits']), (0, 0))
+        # Only maxidle of them are kept open
+        self.assertEquals((stats['opened'], stats['idle']), (5, 5))
+
+    def test_primarykey(self):
+        self.connection.setup(testclasses.gethashkeytables())
+
+        with Session(self.connection) as session:
+            connection = session.connectedbackend.connection
+            for name, definition in (('IntegerKeyTestClass', 'integer'),
+                                     ('CompleteTestClass', 'text')):
+                sql = connection.execute("SELECT sql FROM sqlite_master "
+                                         "WHERE name = ?", (name, )).fetchone()
+                self.assertTrue("_cryo_id %s PRIMARY KEY NOT NULL"
+                                % definition in sql[0])
+
+            # Updates replace the row instead of adding a duplicate
+            testobj = IntegerKeyTestClass(1, 'one')
+            session.append(testobj)
+            session.commit()
+            testobj.name = 'again'
+            session.commit()
+            rows = connection.execute("SELECT _cryo_id, name "
+                                      "FROM 'IntegerKeyTestClass'").fetchall()
+            self.assertEquals([tuple(row) for row in rows], [(1, 'again')])
+
+    def test_upgrade_legacy_table(self):
+        filename = tempfile.mktemp()
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE 'IntegerKeyTestClass' "
+                           "(_cryo_id PRIMARY_KEY UNIQUE, "
+                           "'id' number(20, 0), 'name' text)")
+        connection.execute("INSERT INTO 'IntegerKeyTestClass' "
+                           "VALUES (7, 7, 'legacy')")
+        connection.commit()
+        connection.close()
+
+        backend = SQLiteBackend(filename, modules=[testclasses])
+        connection = backend.newconnection()
+        connection.setup(testclasses.gethashkeytables())
+        connection.setup(testclasses.gethashkeytables())
+
+        with Session(connection) as session:
+            results = list(session.query(Select(IntegerKeyTestClass)))
+            self.assertEquals([(obj.id, obj.name) for obj in results],
+                              [(7, 'legacy')])
+            sql = session.connectedbackend.connection.execute(
+                    "SELECT sql FROM sqlite_master "
+                    "WHERE name = 'IntegerKeyTestClass'").fetchone()[0]
+            self.assertTrue("PRIMARY KEY" in sql)
+        backend.close()
+
+    def test_withoutrowid(self):
+        backend = SQLiteBackend(tempfile.mktemp(), modules=[testclasses],
+                                withoutrowid=True)
+        connection = backend.newconnection()
+        connection.setup(testclasses.gettables())
+
+        with Session(connection) as session:
+            sql = session.connectedbackend.connection.execute(
+                    "SELECT sql FROM sqlite_master "
+                    "WHERE name = 'CompleteTestClass'").fetchone()[0]
+            self.assertTrue(sql.endswith("WITHOUT ROWID"))
+            session.append(CompleteTestClass('withoutrowid'))
+
+        with Session(connection) as session:
+            results = list(session.query(Select(CompleteTestClass)))
+            self.assertEquals([obj.name for obj in results], ['withoutrowid'])
+        backend.close()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copyright (C) 2008  César Izurieta
+
+This file is part of Cryo.
+
+Cryo is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import with_statement
+
+__author__ = "César Izurieta"
+__email__ = "cesar at caih dot org"
+__version__ = "$Revision$"[11:-2]
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from .collection import Collection
+from .connection import Unloaded, freeze, setunloaded
+from .datatypes import Many, One, PythonObject
+
+
+class ResultCache(object):
+    """
+    Results of queries shared by the sessions of a Connection, by the query
+    the backend runs and the values bound to it. Object queries keep the
+    hash keys of their results, so each session loads its own instances,
+    and projections keep their records.
+
+    At most size queries are kept, evicting the least recently used ones.
+    The results read from a table are dropped when a session commits
+    inserts or deletes to it.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self._results = OrderedDict()
+        self._keys = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Returns the results cached for key, or None"""
+
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._results[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, tablename):
+        """
+        Returns how many times tablename was invalidated, to be given to put
+        along with the results read after calling it.
+        """
+
+        with self._lock:
+            return self._generations.get(tablename, 0)
+
+    def put(self, key, tablename, generation, results):
+        """
+        Caches the results of key, read from tablename. Nothing is cached if
+        tablename was invalidated since generation was taken, as the results
+        may be from before the commit.
+        """
+
+        with self._lock:
+            if self._generations.get(tablename, 0) != generation:
+                return
+
+            self._discard(key)
+            while self._results and len(self._results) >= self.size:
+                self._discard(iter(self._results).next())
+                self.evictions += 1
+
+            self._results[key] = (tablename, tuple(results))
+            self._keys.setdefault(tablename, set()).add(key)
+
+    def invalidate(self, *tablenames):
+        with self._lock:
+            for tablename in tablenames:
+                self._generations[tablename] = \
+                    self._generations.get(tablename, 0) + 1
+                for key in self._keys.pop(tablename, ()):
+                    del self._results[key]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for tablename in self._keys:
+                self._generations[tablename] = \
+                    self._generations.get(tablename, 0) + 1
+            self._results = OrderedDict()
+            self._keys = {}
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._results),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
+
+    def _discard(self, key):
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self._keys[entry[0]].discard(key)
+
+
+class _Snapshot(object):
+    """
+    The column values of an object, with the hash keys of the objects its
+    One attributes point to.
+    """
+
+    def __init__(self, table, values, expires):
+        self.table = table
+        self.values = values
+        self.expires = expires
+        self.instance = None
+
+
+class ObjectCache(object):
+    """
+    Objects loaded by hash key, shared by the sessions of every Connection
+    given it, by backend and hash key. Session.get and Session.getmany look
+    objects up here before asking the backend.
+
+    Objects are kept as snapshots of their values. Each get builds a new
+    instance whose foreign keys are loaded lazily through the session that
+    asked for it, unless frozen is True: then the objects of tables without
+    foreign keys are handed out as one shared instance whose attributes
+    can't be set.
+
+    At most size objects are kept, evicting the least recently used ones.
+    Objects expire ttl seconds after they are cached, or ttls[table name]
+    seconds for the tables given there, and None keeps them until they are
+    evicted. Objects inserted, updated or deleted by a commit are dropped,
+    and objects of their tables loaded before the commit aren't cached.
+    """
+
+    def __init__(self, size=1024, ttl=None, ttls=None, frozen=False):
+        self.size = size
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.frozen = frozen
+        self._snapshots = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, session, table, hashkey):
+        """Returns the object of table with hashkey for session, or None"""
+
+        key = (session.connection.backend, hashkey)
+        with self._lock:
+            snapshot = self._snapshots.pop(key, None)
+            if snapshot is not None and snapshot.expires is not None and \
+               snapshot.expires <= time.time():
+                snapshot = None
+                self.expirations += 1
+
+            if snapshot is None:
+                self.misses += 1
+                return None
+
+            self._snapshots[key] = snapshot
+            # Each connection sets up its own tables
+            if snapshot.table.classname != table.classname:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            if snapshot.instance is not None:
+                return snapshot.instance
+
+        obj = self._build(session, table, snapshot)
+        if self.frozen and not table.foreignkeys:
+            freeze(obj)
+            with self._lock:
+                if snapshot.instance is None:
+                    snapshot.instance = obj
+                return snapshot.instance
+        return obj
+
+    def generation(self, backend, tablename):
+        """
+        Returns how many times the objects of tablename in backend were
+        invalidated, to be given to put along with the objects loaded after
+        calling it.
+        """
+
+        with self._lock:
+            return self._generations.get((backend, tablename), 0)
+
+    def put(self, session, table, hashkey, obj, generation):
+        """
+        Caches obj, the object of table with hashkey. Nothing is cached if
+        objects of table were invalidated since generation was taken, as obj
+        may be from before the commit.
+        """
+
+        ttl = self.ttls.get(table.name, self.ttl)
+        snapshot = _Snapshot(table, self._values(session, table, obj),
+                             ttl is not None and time.time() + ttl or None)
+
+        backend = session.connection.backend
+        with self._lock:
+            if self._generations.get((backend, table.name), 0) != generation:
+                return
+
+            self._snapshots.pop((backend, hashkey), None)
+            while self._snapshots and len(self._snapshots) >= self.size:
+                self._snapshots.popitem(last=False)
+                self.evictions += 1
+            self._snapshots[(backend, hashkey)] = snapshot
+
+    def invalidate(self, backend, tablename, hashkeys):
+        with self._lock:
+            self._generations[(backend, tablename)] = \
+                self._generations.get((backend, tablename), 0) + 1
+            for hashkey in hashkeys:
+                if self._snapshots.pop((backend, hashkey), None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            for (backend, hashkey), snapshot in self._snapshots.items():
+                key = (backend, snapshot.table.name)
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._snapshots = OrderedDict()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._snapshots),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
+
+    def _values(self, session, table, obj):
+        values = {}
+        for name, column in table.columns.items():
+            value = session.connectedbackend.getvalue(obj, name)
+            if isinstance(value, Unloaded):
+                value = value.hashkey
+            elif value is not None and isinstance(column.datatype, One):
+                value = session.gethashkey(value)
+            elif isinstance(column.datatype, PythonObject):
+                value = copy.deepcopy(value)
+            values[name] = value
+        return values
+
+    def _build(self, session, table, snapshot):
+        obj = table.class_()
+        for name, value in snapshot.values.items():
+            datatype = table.columns[name].datatype
+            if not isinstance(datatype, One) or value is None:
+                if isinstance(datatype, PythonObject):
+                    value = copy.deepcopy(value)
+                setattr(obj, name, value)
+            elif value in session:
+                setattr(obj, name, session[value])
+            else:
+                setunloaded(obj, name, Unloaded(session, datatype.class_,
+                                                value))
+
+        for name, column in table.foreignkeys.items():
+            if isinstance(column.datatype, Many):
+                setattr(obj, name, Collection(session, obj, name))
+        return obj
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copyright (C) 2008  César Izurieta
+
+This file is part of Cryo.
+
+Cryo is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__ = "César Izurieta"
+__email__ = "cesar at caih dot org"
+__version__ = "$Revision$"[11:-2]
+
+from . import exceptions
+
+
+def _loading(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        self.load()
+        return method(self, *args)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+def _changing(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args):
+        self.load()
+        before = list(list.__iter__(self))
+        result = method(self, *args)
+        self._track(before, list(list.__iter__(self)))
+        return result
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+class Collection(list):
+    """
+    The objects of the Many attribute name of obj, which are the objects
+    whose inverse One attribute points to obj. It is loaded through session
+    the first time it is used. Appends and removes are recorded and written
+    when the session commits by setting (or clearing) the inverse attribute
+    of the objects involved, so the rest of the collection is not touched.
+    """
+
+    def __init__(self, session, obj, name):
+        list.__init__(self)
+        self.session = session
+        self.obj = obj
+        self.name = name
+        self.loaded = False
+        self.added = []
+        self.removed = []
+
+    def load(self):
+        if not self.loaded:
+            if self.session.closed:
+                raise exceptions.SessionClosed("Can't load %s of %s"
+                                               % (self.name, self.obj))
+            self.session.prefetch([self.obj], self.name)
+
+    def setloaded(self, objs):
+        list.__init__(self, objs)
+        self.loaded = True
+        self.added = []
+        self.removed = []
+
+    def unload(self):
+        list.__init__(self)
+        self.loaded = False
+        self.added = []
+        self.removed = []
+
+    def __reduce__(self):
+        # Copies are plain lists, as they aren't bound to the session
+        self.load()
+        return (list, (list(self), ))
+
+    def flush(self):
+        """Points the added objects to obj and the removed ones to None"""
+
+        connectedbackend = self.session.connectedbackend
+        table = self.session.gettable(self.obj)
+        target, inverse = connectedbackend.getinverse(table, self.name)
+
+        for obj in self.added:
+            if not connectedbackend.pointsto(obj, inverse, self.obj):
+                setattr(obj, inverse, self.obj)
+            self.session.append(obj)
+
+        for obj in self.removed:
+            if connectedbackend.pointsto(obj, inverse, self.obj):
+                setattr(obj, inverse, None)
+                self.session.append(obj)
+
+        self.added = []
+        self.removed = []
+
+    def _add(self, obj):
+        if _index(self.removed, obj) is not None:
+            del self.removed[_index(self.removed, obj)]
+        else:
+            self.added.append(obj)
+        self.session.changed(self)
+
+    def _remove(self, obj):
+        if _index(self.added, obj) is not None:
+            del self.added[_index(self.added, obj)]
+        else:
+            self.removed.append(obj)
+        self.session.changed(self)
+
+    def _track(self, before, after):
+        for obj in before:
+            if _index(after, obj) is None:
+                self._remove(obj)
+        for obj in after:
+            if _index(before, obj) is None:
+                self._add(obj)
+
+    def append(self, obj):
+        self.load()
+        list.append(self, obj)
+        self._add(obj)
+
+    def extend(self, objs):
+        for obj in objs:
+            self.append(obj)
+
+    def __iadd__(self, objs):
+        self.extend(objs)
+        return self
+
+    def insert(self, index, obj):
+        self.load()
+        list.insert(self, index, obj)
+        self._add(obj)
+
+    def remove(self, obj):
+        self.load()
+        list.remove(self, obj)
+        self._remove(obj)
+
+    def pop(self, *args):
+        self.load()
+        obj = list.pop(self, *args)
+        self._remove(obj)
+        return obj
+
+    __setitem__ = _changing('__setitem__')
+    __delitem__ = _changing('__delitem__')
+    __setslice__ = _changing('__setslice__')
+    __delslice__ = _changing('__delslice__')
+
+    __len__ = _loading('__len__')
+    __iter__ = _loading('__iter__')
+    __reversed__ = _loading('__reversed__')
+    __contains__ = _loading('__contains__')
+    __getitem__ = _loading('__getitem__')
+    __getslice__ = _loading('__getslice__')
+    __eq__ = _loading('__eq__')
+    __ne__ = _loading('__ne__')
+    __repr__ = _loading('__repr__')
+    index = _loading('index')
+    count = _loading('count')
+    sort = _loading('sort')
+    reverse = _loading('reverse')
+
+
+def _index(objs, obj):
+    for index, other in enumerate(objs):
+        if other is obj:
+            return index
+    return None
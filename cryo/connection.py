@@ -27,28 +27,231 @@ __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
 import hashlib
+import operator
+import pickle
+import weakref
 
 from . import exceptions
 from . import util
+from .hashkeys import Digest
 from .metadata import Table
-from .datatypes import LongText, PythonObject
+from .datatypes import LongText, PythonObject, One
 from .session import Session
 
 import cryo
 
+_HASHKEY = '_cryo_hashkey'
+_FULLHASHKEY = '_cryo_fullhashkey'
+# Unloaded targets of lazy foreign keys by attribute
+_LAZY = '_cryo_lazy'
+# Set on objects whose attributes can't be set anymore
+_FROZEN = '_cryo_frozen'
+# State that isn't pickled along with the objects
+_TRANSIENT = frozenset([_HASHKEY, _FULLHASHKEY, _FROZEN])
+
+_VALUE, _FOREIGNKEY, _PYTHONOBJECT = range(3)
+
+# Full hash keys are only compared in memory, so they always use the default
+_FULLHASHKEY_STRATEGY = Digest()
+
+# Compiled attribute extractors by table and attributes
+_extractors = weakref.WeakKeyDictionary()
+
+# Names of the classes whose objects the hash key of attributes depends on,
+# by table and attributes
+_dependencies = weakref.WeakKeyDictionary()
+
+# Bumped by class name whenever a primary key attribute of an object with a
+# cached hash key changes, since the hash keys of the objects that point to
+# it are stale too.
+_generations = {}
+
+
+class Unloaded(object):
+    """
+    Stands for the target of a lazy foreign key until it is first read, which
+    loads it through session, adding it to the session unless track is False.
+    """
+
+    def __init__(self, session, class_, hashkey, track=True):
+        self.session = session
+        self.class_ = class_
+        self.hashkey = hashkey
+        self.track = track
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (util.fullname(self.__class__),
+                               util.fullname(self.class_), repr(self.hashkey))
+
+    def __getstate__(self):
+        # A copy isn't bound to any session, so it can't be loaded
+        state = dict(self.__dict__)
+        state['session'] = None
+        return state
+
+
+def setunloaded(obj, name, unloaded):
+    """Makes the attribute name of obj load unloaded on first access"""
+
+    obj.__dict__.pop(name, None)
+    obj.__dict__.setdefault(_LAZY, {})[name] = unloaded
+
+
+def freeze(obj):
+    """Makes setting the mapped attributes of obj raise Frozen"""
+
+    obj.__dict__[_FROZEN] = True
+
+
+def _instrument(table):
+    """
+    Wraps __setattr__ of the table's class so that writing a mapped attribute
+    drops the hash keys cached on the object, __getattr__ so that lazy
+    foreign keys are loaded when read, and __getstate__ so that the cached
+    hash keys aren't pickled.
+    """
+
+    class_ = table.class_
+
+    if '_cryo_columns' not in class_.__dict__:
+        original = getattr(class_, '__setattr__', None)
+        originalgetattr = getattr(class_, '__getattr__', None)
+        originalgetstate = getattr(class_, '__getstate__', None)
+
+        def __setattr__(self, name, value):
+            if name in self._cryo_columns:
+                if self.__dict__.get(_FROZEN):
+                    raise exceptions.Frozen("Can't set %s of %s, it is "
+                                            "shared by the sessions"
+                                            % (name, self))
+                _invalidate(self, name)
+            if original is None:
+                self.__dict__[name] = value
+            else:
+                original(self, name, value)
+
+        def __getattr__(self, name):
+            lazy = self.__dict__.get(_LAZY)
+            if lazy and name in lazy:
+                return _load(self, name)
+            elif originalgetattr is not None:
+                return originalgetattr(self, name)
+            raise AttributeError(name)
+
+        def __getstate__(self):
+            if originalgetstate is None:
+                state = self.__dict__
+            else:
+                state = originalgetstate(self)
+            if isinstance(state, dict):
+                state = dict([(name, value) for name, value in state.items()
+                              if name not in _TRANSIENT])
+            return state
+
+        class_.__setattr__ = __setattr__
+        class_.__getattr__ = __getattr__
+        class_.__getstate__ = __getstate__
+        class_._cryo_columns = frozenset()
+        class_._cryo_primarykey = frozenset()
+
+    class_._cryo_columns = class_._cryo_columns.union(table.columns)
+    class_._cryo_primarykey = class_._cryo_primarykey.union(table.primarykey)
+
+
+def _load(obj, name):
+    unloaded = obj.__dict__[_LAZY][name]
+    if unloaded.session is None or unloaded.session.closed:
+        raise exceptions.SessionClosed("Can't load %s of %s" % (name, obj))
+
+    value = unloaded.session.get(unloaded.class_, unloaded.hashkey)
+    if value is not None and unloaded.track:
+        unloaded.session.append(value, dirty=False, recursive=True)
+
+    # Same hash key as before, so the cached keys are still valid
+    obj.__dict__[name] = value
+    del obj.__dict__[_LAZY][name]
+    return value
+
+
+def _invalidate(obj, name):
+    state = obj.__dict__
+    if _LAZY in state:
+        state[_LAZY].pop(name, None)
+    if _FULLHASHKEY in state:
+        del state[_FULLHASHKEY]
+    if name in obj._cryo_primarykey and _HASHKEY in state:
+        del state[_HASHKEY]
+        classname = util.fullname(obj.__class__)
+        _generations[classname] = _generations.get(classname, 0) + 1
+
+
+class _Traversal(object):
+    """
+    Hash keys computed while walking a graph of objects, and what a pointer to
+    each member of the cycle being hashed stands for.
+    """
+
+    def __init__(self):
+        self.hashkeys = {}
+        self.cycles = {}
+
 
 class Connection(object):
 
-    def __init__(self, backend):
+    def __init__(self, backend, resultcache=None, objectcache=None):
         self.backend = backend
         self.tables = {}
+        # A cache.ResultCache shared by the sessions, if any
+        self.resultcache = resultcache
+        # A cache.ObjectCache for Session.get, which may be shared with
+        # other connections
+        self.objectcache = objectcache
+        self._tableorder = None
 
     def setup(self, *tables):
         # FIXME: check if we need to update!
+        tables = util.flatten(tables)
+        for table in tables:
+            # Registered first so foreign keys can see the tables they point
+            # to when the columns are created
+            self.tables[table.classname] = table
+            _instrument(table)
+        self._tableorder = None
+
         with Session(self) as session:
-            for table in util.flatten(tables):
+            for table in tables:
                 session.connectedbackend.createtable(table)
-                self.tables[table.classname] = table
+                for index in table.indexes:
+                    session.connectedbackend.createindex(table, index)
+
+    def sorttables(self, tables):
+        """
+        Sorts tables so that the tables their foreign keys point to come
+        first. Tables that point to each other are kept in name order.
+        """
+
+        if self._tableorder is None:
+            order = []
+            visited = set()
+
+            def visit(table):
+                if table.classname in visited:
+                    return
+                visited.add(table.classname)
+                for column in table.foreignkeys.values():
+                    if (isinstance(column.datatype, One) and
+                        column.datatype.classname in self.tables):
+                        visit(self.tables[column.datatype.classname])
+                order.append(table)
+
+            for table in sorted(self.tables.values(), key=lambda t: t.name):
+                visit(table)
+
+            self._tableorder = dict((table.classname, index)
+                                    for index, table in enumerate(order))
+
+        return sorted(tables, key=lambda table:
+                      self._tableorder.get(table.classname, -1))
 
 
 class Backend(object):
@@ -59,8 +262,8 @@ class Backend(object):
                              for module in (modules or [])])
         self.modules[util.fixtest(cryo.__name__)] = cryo
 
-    def newconnection(self):
-        return Connection(self)
+    def newconnection(self, resultcache=None, objectcache=None):
+        return Connection(self, resultcache, objectcache)
 
     def connect(self):
         pass
@@ -68,42 +271,340 @@ class Backend(object):
 
 class ConnectedBackend(object):
 
+    # Whether every session gets the same instances of the stored objects
+    sharesobjects = False
+
     def __init__(self, backend, session):
         self.backend = backend
         self.session = session
 
     def gethashkey(self, obj):
         table = self.session.gettable(obj)
-        return self._gethashkey(obj, table, table.primarykey)
+        return self._cachedhashkey(obj, table, _HASHKEY, table.primarykey)
+
+    def gethashkeys(self, objs):
+        """
+        Returns the hash keys of objs in the same order. The objects are
+        grouped by table so each table is looked up once, and the keys of the
+        objects they point to are computed only once for the whole batch.
+        """
+
+        objs = util.flatten(objs)
+        hashkeys = [None] * len(objs)
+        traversal = _Traversal()
+
+        groups = {}
+        for index, obj in enumerate(objs):
+            groups.setdefault(obj.__class__, []).append(index)
+
+        for class_, indexes in groups.items():
+            table = self.session.gettable(class_=class_)
+            for index in indexes:
+                obj = objs[index]
+                hashkey = traversal.hashkeys.get(id(obj))
+                if hashkey is None:
+                    hashkey = self._cachedhashkey(obj, table, _HASHKEY,
+                                                  table.primarykey, traversal)
+                hashkeys[index] = hashkey
+
+        return hashkeys
 
     def getfullhashkey(self, obj):
         table = self.session.gettable(obj)
-        return self._gethashkey(obj, table, table.columns.keys())
+        if table.pythonobjects:
+            # python objects can change in place without going through
+            # __setattr__, so these can't be cached
+            return self._gethashkey(obj, table, tuple(table.columns),
+                                    full=True)
+        return self._cachedhashkey(obj, table, _FULLHASHKEY,
+                                   tuple(table.columns))
+
+    def _cachedhashkey(self, obj, table, cachename, attributes,
+                       traversal=None):
+        cached = obj.__dict__.get(cachename)
+        stamp = self._stamp(table, attributes)
+        if cached is not None and cached[0] is table and cached[1] == stamp:
+            return cached[2]
+
+        traversal = traversal or _Traversal()
+        if cachename == _HASHKEY:
+            self._traverse(obj, table, traversal)
+            return traversal.hashkeys[id(obj)]
+
+        hashkey = self._gethashkey(obj, table, attributes, traversal,
+                                   full=cachename == _FULLHASHKEY)
+        obj.__dict__[cachename] = (table, stamp, hashkey)
+        return hashkey
+
+    def _stamp(self, table, attributes):
+        """
+        Returns the generations of the classes whose objects the hash key
+        of attributes of table depends on through its foreign keys. A
+        cached hash key is valid while these stay the same.
+        """
+
+        dependencies = _dependencies.setdefault(table, {})
+        classnames = dependencies.get(attributes)
+        if classnames is None:
+            classnames = self._dependson(table, attributes)
+            dependencies[attributes] = classnames
+        return tuple([_generations.get(classname, 0)
+                      for classname in classnames])
+
+    def _dependson(self, table, attributes):
+        tables = self.session.connection.tables
+        classnames = set()
+        pending = [(table, attributes)]
+        while pending:
+            current, names = pending.pop()
+            for name in names:
+                column = current.foreignkeys.get(name)
+                if column is None or not isinstance(column.datatype, One):
+                    continue
+
+                classname = column.datatype.classname
+                if classname not in classnames and classname in tables:
+                    classnames.add(classname)
+                    target = tables[classname]
+                    pending.append((target, target.primarykey))
+        return tuple(sorted(classnames))
+
+    def _traverse(self, obj, table, traversal):
+        """
+        Computes and caches the hash keys of obj and of the objects its
+        primary key points to. The objects are walked with an explicit stack
+        so that long chains don't exhaust the recursion limit.
+
+        Objects that point to each other are hashed together once all of
+        them have been walked (Tarjan's algorithm). A pointer to a member of
+        the same cycle is hashed as a digest of the whole cycle, so that the
+        key of each member doesn't depend on where the cycle was entered.
+        """
+
+        order = {id(obj): 0}
+        lowest = {id(obj): 0}
+        selfpointing = set()
+        pending = [(obj, table)]
+        stack = [(obj, self._targets(obj, table, traversal))]
+        while stack:
+            current, targets = stack[-1]
+            for target, targettable in targets:
+                if id(target) in traversal.hashkeys:
+                    continue
+                elif id(target) not in order:
+                    order[id(target)] = lowest[id(target)] = len(order)
+                    pending.append((target, targettable))
+                    stack.append((target, self._targets(target, targettable,
+                                                        traversal)))
+                    break
+                elif target is current:
+                    selfpointing.add(id(current))
+                else:
+                    lowest[id(current)] = min(lowest[id(current)],
+                                              order[id(target)])
+            else:
+                stack.pop()
+                if stack:
+                    parent = id(stack[-1][0])
+                    lowest[parent] = min(lowest[parent], lowest[id(current)])
+                if lowest[id(current)] == order[id(current)]:
+                    index = len(pending) - 1
+                    while pending[index][0] is not current:
+                        index -= 1
+                    self._hashcycle(pending[index:],
+                                    id(current) in selfpointing, traversal)
+                    del pending[index:]
+
+    def _targets(self, obj, table, traversal):
+        """
+        Yields the objects the primary key of obj points to whose hash key
+        isn't known yet, along with their tables.
+        """
+
+        for name in table.primarykey:
+            column = table.foreignkeys.get(name)
+            if column is None or not isinstance(column.datatype, One):
+                continue
+
+            value = self.getvalue(obj, name)
+            if (value is None or isinstance(value, Unloaded) or
+                id(value) in traversal.hashkeys):
+                continue
 
-    def _gethashkey(self, obj, table, attributes):
+            try:
+                target = self.session.gettable(value)
+            except exceptions.NotMapped:
+                continue
+
+            cached = value.__dict__.get(_HASHKEY)
+            if (cached is not None and cached[0] is target and
+                cached[1] == self._stamp(target, target.primarykey)):
+                traversal.hashkeys[id(value)] = cached[2]
+            else:
+                yield value, target
+
+    def _hashcycle(self, members, cyclic, traversal):
+        """
+        Hashes members, the objects of a cycle along with their tables, once
+        the keys of everything else they point to are known. A single object
+        is only a cycle if it points to itself.
+        """
+
+        if len(members) > 1 or cyclic:
+            for member, table in members:
+                traversal.cycles[id(member)] = "_cryo_cycle"
+            digests = sorted([self._gethashkey(member, table,
+                                               table.primarykey, traversal)
+                              for member, table in members])
+            cycle = "_cryo_cycle:" + hashlib.sha1("".join(digests)).hexdigest()
+            for member, table in members:
+                traversal.cycles[id(member)] = cycle
+
+        hashkeys = [self._gethashkey(member, table, table.primarykey,
+                                     traversal, table.hashkey)
+                    for member, table in members]
+        for (member, table), hashkey in zip(members, hashkeys):
+            stamp = self._stamp(table, table.primarykey)
+            traversal.cycles.pop(id(member), None)
+            traversal.hashkeys[id(member)] = hashkey
+            member.__dict__[_HASHKEY] = (table, stamp, hashkey)
+
+    def _gethashkey(self, obj, table, attributes, traversal=None,
+                    strategy=None, full=False):
         fullname = util.fullname(obj.__class__)
         if fullname != table.classname:
             raise exceptions.InvalidValue('Value is not of table\'s ' +
                                           'class: %s != %s'
                                           % (fullname, table.classname))
-        hashkey = hashlib.sha1()
-        hashkey.update(fullname)
-        for attr in attributes:
-            value = getattr(obj, attr)
-            try:
-                valuehash = str(self.gethashkey(value))
-                hashkey.update(valuehash)
-            except exceptions.NotMapped:
-                if value is None:
-                    hashkey.update("_cryo_None")
+
+        getter, kinds = self._extractor(table, attributes)
+        if obj.__dict__.get(_LAZY):
+            values = tuple([self.getvalue(obj, attr) for attr in attributes])
+        else:
+            values = getter(obj)
+        parts = self._encode(kinds, values, traversal or _Traversal(), full)
+
+        return (strategy or _FULLHASHKEY_STRATEGY).hashkey(table, values,
+                                                           parts)
+
+    def _encode(self, kinds, values, traversal, full=False):
+        for kind, value in zip(kinds, values):
+            if value is None:
+                yield "_cryo_None"
+            elif kind == _FOREIGNKEY:
+                yield str(self._foreignhashkey(value, traversal))
+            elif kind == _PYTHONOBJECT and full:
+                # str() of an instance only shows its identity, so changes
+                # made in place would go unnoticed. The pickle isn't stable
+                # enough for identities (dicts and sets may come out in any
+                # order), at worst it writes an object that didn't change.
+                yield pickle.dumps(value, 2)
+            else:
+                yield str(value)
+
+    def _foreignhashkey(self, value, traversal):
+        if isinstance(value, Unloaded):
+            return value.hashkey
+
+        hashkey = traversal.hashkeys.get(id(value))
+        if hashkey is None:
+            hashkey = traversal.cycles.get(id(value))
+        if hashkey is not None:
+            return hashkey
+
+        try:
+            table = self.session.gettable(value)
+        except exceptions.NotMapped:
+            return value
+
+        return self._cachedhashkey(value, table, _HASHKEY, table.primarykey,
+                                   traversal)
+
+    def getinverse(self, table, name):
+        """
+        Returns the table that the Many attribute name of table points to and
+        its One attribute pointing back. That is either the inverse of the
+        Many or the One whose inverse is name.
+        """
+
+        datatype = table.foreignkeys[name].datatype
+        target = self.session.gettable(class_=datatype.class_)
+        if datatype.inverse is not None:
+            return target, datatype.inverse
+
+        for attr, column in target.foreignkeys.items():
+            if (isinstance(column.datatype, One) and
+                column.datatype.classname == table.classname and
+                column.datatype.inverse == name):
+                return target, attr
+
+        raise exceptions.InvalidValue("%s.%s has no inverse" % (table.name,
+                                                                name))
+
+    def pointsto(self, obj, name, target):
+        """Returns whether the One attribute name of obj points to target"""
+
+        value = self.getvalue(obj, name)
+        if value is None:
+            return False
+        elif value is target:
+            return True
+        elif isinstance(value, Unloaded):
+            return value.hashkey == self.gethashkey(target)
+        return self.gethashkey(value) == self.gethashkey(target)
+
+    def getcollections(self, table, name, objs):
+        """
+        Returns a list with the objects of the Many attribute name of each of
+        objs, all of them of table.
+        """
+
+        raise NotImplementedError()
+
+    def getvalue(self, obj, name):
+        """
+        Returns the value of the attribute name of obj, or its Unloaded
+        target if it is a lazy foreign key that hasn't been read yet.
+        """
+
+        lazy = obj.__dict__.get(_LAZY)
+        if lazy and name in lazy:
+            return lazy[name]
+        return getattr(obj, name)
+
+    def _extractor(self, table, attributes):
+        """
+        Returns a function that gets the values of attributes from an object
+        as a tuple, along with how each of them has to be hashed.
+        """
+
+        extractors = _extractors.setdefault(table, {})
+        if attributes not in extractors:
+            if len(attributes) == 1:
+                attrgetter = operator.attrgetter(attributes[0])
+                getter = lambda obj: (attrgetter(obj), )
+            else:
+                getter = operator.attrgetter(*attributes)
+
+            kinds = []
+            for attr in attributes:
+                if attr in table.foreignkeys:
+                    kinds.append(_FOREIGNKEY)
+                elif attr in table.pythonobjects:
+                    kinds.append(_PYTHONOBJECT)
                 else:
-                    hashkey.update(str(value))
+                    kinds.append(_VALUE)
 
-        return hashkey.hexdigest()
+            extractors[attributes] = (getter, tuple(kinds))
+
+        return extractors[attributes]
 
     def createtable(self, table):
         raise NotImplementedError()
 
+    def createindex(self, table, index):
+        raise NotImplementedError()
+
     def insert(self, *objs):
         raise NotImplementedError()
 
@@ -113,9 +614,33 @@ class ConnectedBackend(object):
     def get(self, table, hashkey):
         raise NotImplementedError()
 
-    def query(self, query):
+    def getmany(self, table, hashkeys):
+        """
+        Returns the objects of table with hashkeys, None for the ones that
+        don't exist.
+        """
+
+        return [self.get(table, hashkey) for hashkey in hashkeys]
+
+    def query(self, query, track=True):
+        """
+        Yields the results of query. With track False nothing is added to
+        the session, neither the results nor the objects loaded for them.
+        """
+
         raise NotImplementedError()
 
+    def cachekey(self, select):
+        """
+        Returns what identifies the results of select in a ResultCache, or
+        None if they can't be cached.
+        """
+
+        return None
+
+    def execute(self, prepared, params):
+        return self.query(prepared.bind(params))
+
     def commit(self):
         raise NotImplementedError()
 
@@ -70,6 +70,19 @@ class Text(Datatype):
         return str
 
 
+class Binary(Datatype):
+
+    def __init__(self, length):
+        self.length = length
+        Datatype.__init__(self)
+
+    def __repr__(self):
+        return "%s(%s)" % (util.fullname(self.__class__), self.length)
+
+    def type(self):
+        return str
+
+
 class Number(Datatype):
 
     def __init__(self, length, decimals=0):
@@ -87,7 +100,7 @@ class Number(Datatype):
             return Datatype.__repr__(self)
 
     def type(self):
-        if decimals:
+        if self.decimals:
             return float
         else:
             return int
@@ -127,8 +140,10 @@ class ForeignKey(Datatype):
 
 class One(ForeignKey):
 
-    def __init__(self, class_, inverse=None, autofetch=True):
+    def __init__(self, class_, inverse=None, autofetch=True, join=False):
         ForeignKey.__init__(self, class_, inverse, autofetch)
+        # Load the target in the same statement as the object
+        self.join = join
 
 
 class Many(ForeignKey):
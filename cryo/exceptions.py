@@ -45,6 +45,14 @@ class NotMapped(InvalidValue):
                               util.fullname(class_), exception)
 
 
+class DuplicateEntry(InvalidValue):
+
+    def __init__(self, index='', exception=None):
+        self.index = index
+        InvalidValue.__init__(self, 'Duplicate entry for unique index %s' %
+                              index, exception)
+
+
 class TableDoesNotExist(Exception):
 
     def __init__(self, tablename = '', exception=None):
@@ -54,3 +62,35 @@ class TableDoesNotExist(Exception):
 
     def __str__(self):
         return "%s: %s" % (str(self.tablename), repr(self.exception))
+
+
+class SessionClosed(Exception):
+
+    def __init__(self, message=''):
+        self.message = message
+        Exception.__init__(self)
+
+    def __str__(self):
+        return str(self.message)
+
+
+class Frozen(Exception):
+
+    def __init__(self, message=''):
+        self.message = message
+        Exception.__init__(self)
+
+    def __str__(self):
+        return str(self.message)
+
+
+class PoolTimeout(Exception):
+
+    def __init__(self, size=0, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        Exception.__init__(self)
+
+    def __str__(self):
+        return "All %s connections in use after %s seconds" % (self.size,
+                                                              self.timeout)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copyright (C) 2008  César Izurieta
+
+This file is part of Cryo.
+
+Cryo is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__ = "César Izurieta"
+__email__ = "cesar at caih dot org"
+__version__ = "$Revision$"[11:-2]
+
+import hashlib
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+from . import exceptions
+from . import util
+from .datatypes import Binary, Number, Text
+
+
+class HashKey(object):
+    """
+    Builds the hash key that identifies an object of a table. The hash key is
+    stored in the _cryo_id column and in the foreign keys that point to the
+    object, using datatype as the column type.
+    """
+
+    def __init__(self, datatype):
+        self.datatype = datatype
+
+    def __repr__(self):
+        return "%s()" % (util.fullname(self.__class__))
+
+    def hashkey(self, table, values, parts):
+        """
+        Returns the hash key of an object given the values of its primary key
+        and those values encoded as strings.
+        """
+
+        raise NotImplementedError()
+
+    def todb(self, hashkey):
+        """Converts a hash key to be stored on the database"""
+
+        return hashkey
+
+    def fromdb(self, table, value):
+        """Converts a hash key pulled from the database"""
+
+        return value
+
+
+class Digest(HashKey):
+    """
+    Hashes the primary key with one of the algorithms of hashlib (or blake2b),
+    keeping the first length bytes of the digest. The key is a hex string
+    unless binary is True, in which case the raw bytes are used.
+    """
+
+    def __init__(self, algorithm='sha1', length=None, binary=False):
+        if algorithm == 'blake2b' and blake2b is None:
+            raise ValueError('blake2b needs python 2.7.x with pyblake2 '
+                             'installed or python 3.6+')
+
+        self.algorithm = algorithm
+        self.length = length
+        self.binary = binary
+
+        size = length or self.new().digest_size
+        if binary:
+            HashKey.__init__(self, Binary(size))
+        else:
+            HashKey.__init__(self, Text(size * 2))
+
+    def new(self):
+        """Returns a new hash object of the algorithm"""
+
+        if self.algorithm == 'blake2b':
+            return blake2b(digest_size=self.length or 64)
+        return hashlib.new(self.algorithm)
+
+    def __repr__(self):
+        arguments = [repr(self.algorithm)]
+        if self.length or self.binary:
+            arguments.append(repr(self.length))
+        if self.binary:
+            arguments.append(repr(self.binary))
+        return "%s(%s)" % (util.fullname(self.__class__), ", ".join(arguments))
+
+    def hashkey(self, table, values, parts):
+        hashkey = self.new()
+        hashkey.update(table.classname)
+        for part in parts:
+            hashkey.update(part)
+
+        if self.binary:
+            return hashkey.digest()[:self.length]
+        else:
+            return hashkey.hexdigest()[:self.length and self.length * 2]
+
+    def todb(self, hashkey):
+        if self.binary and hashkey is not None:
+            return buffer(hashkey)
+        return hashkey
+
+    def fromdb(self, table, value):
+        if self.binary and value is not None:
+            return str(value)
+        return value
+
+
+class IntegerKey(HashKey):
+    """
+    Uses the value of a single integer primary key directly. The in-memory
+    hash key carries the table name so keys of different tables don't
+    collide, only the integer is stored on the database.
+    """
+
+    def __init__(self):
+        HashKey.__init__(self, Number(20))
+
+    def hashkey(self, table, values, parts):
+        if len(values) != 1 or values[0] is None:
+            raise exceptions.InvalidValue('%s needs a single not null '
+                                          'primary key: %s'
+                                          % (repr(self), table.primarykey))
+        return (table.name, int(values[0]))
+
+    def todb(self, hashkey):
+        if hashkey is None:
+            return None
+        return hashkey[1]
+
+    def fromdb(self, table, value):
+        if value is None:
+            return None
+        return (table.name, int(value))
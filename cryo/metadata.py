@@ -24,14 +24,16 @@ __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
-from .datatypes import guessdbdatatype, ForeignKey, Many, Unknown
+from .datatypes import guessdbdatatype, ForeignKey, Many, Unknown, \
+                       PythonObject
+from .hashkeys import Digest
 from . import util
 
 
 class Table(object):
 
     def __init__(self, class_=None, name=None, attributes=None, example=None,
-                 primarykey=None):
+                 primarykey=None, hashkey=None, indexes=None):
         if class_ is not None:
             attributes = attributes or {}
             obj = example or class_()
@@ -48,10 +50,20 @@ class Table(object):
             self.classname = util.fullname(class_)
             self.columns = {}
             self.foreignkeys = {}
+            self.pythonobjects = {}
             self._generatecolumns(attributes)
             self.primarykey = primarykey or tuple(sorted(self.columns.keys()))
             if isinstance(self.primarykey, str):
                 self.primarykey = (self.primarykey, )
+            self.primarykey = tuple(self.primarykey)
+            self.hashkey = hashkey or Digest()
+
+            self.indexes = []
+            for attr, column in sorted(self.columns.items()):
+                if column.indexed or column.unique:
+                    self._addindex(Index(attr, unique=column.unique))
+            for index in indexes or []:
+                self._addindex(index)
 
     def _generatecolumns(self, attributes):
         for attr, value in attributes.items():
@@ -66,17 +78,52 @@ class Table(object):
         if isinstance(column.datatype, ForeignKey):
             self.foreignkeys[attr] = column
 
+        if isinstance(column.datatype, PythonObject):
+            self.pythonobjects[attr] = column
+
         if (not isinstance(column.datatype, Many) and
             not isinstance(column.datatype, Unknown)):
             self.columns[attr] = column
 
+    def _addindex(self, index):
+        for attr in index.columns:
+            if attr not in self.columns:
+                raise ValueError("Can't index %s, %s has no column %s"
+                                 % (index.columns, self.name, attr))
+
+        # Copied so the same Index can be given to several tables
+        name = index.name or "%s_%s_index" % (self.name,
+                                              "_".join(index.columns))
+        self.indexes.append(Index(index.columns, name, index.unique))
+
 
 class Column(object):
 
-    def __init__(self, name, datatype):
+    def __init__(self, name, datatype, indexed=False, unique=False):
         self.name = name
         self.datatype = datatype
+        self.indexed = indexed
+        self.unique = unique
 
     def __repr__(self):
         return "%s('%s', %s)" % (util.fullname(self.__class__), self.name,
                                  self.datatype)
+
+
+class Index(object):
+    """
+    A secondary index over one or more columns (given by attribute name) of a
+    table, created by Connection.setup. Unique indexes reject two objects
+    with the same values, unless one of them is None.
+    """
+
+    def __init__(self, columns, name=None, unique=False):
+        if isinstance(columns, str):
+            columns = (columns, )
+        self.columns = tuple(columns)
+        self.name = name
+        self.unique = unique
+
+    def __repr__(self):
+        return "%s(%s, %s, %s)" % (util.fullname(self.__class__),
+                                   self.columns, repr(self.name), self.unique)
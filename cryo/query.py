@@ -24,10 +24,16 @@ __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
+import sys
 from types import TupleType
+import weakref
+from collections import namedtuple
 
 from . import util
 
+# Classes of the records returned by projections, by their fields
+_records = {}
+
 
 class Query(object):
 
@@ -44,6 +50,12 @@ class Select(Query):
         self.whereclause = None
         self.orderbyclauses = []
         self.limitclause = None
+        self.joins = []
+        self.prefetches = []
+        self.projection = []
+        self.groupbys = []
+        self.keyset = False
+        self.afterkey = None
         Query.__init__(self)
 
     def where(self, value=None, *args):
@@ -81,10 +93,182 @@ class Select(Query):
                 self.orderbyclauses.append(OrderByClause(orderbyclause))
         return self
 
+    def join(self, *names):
+        """Loads the targets of the One attributes names along the results"""
+
+        self.joins.extend(names)
+        return self
+
+    def prefetch(self, *names):
+        """
+        Loads the Many attributes names of the results with one query per
+        attribute and page of results.
+        """
+
+        self.prefetches.extend(names)
+        return self
+
+    def columns(self, *fields):
+        """
+        Returns records with just the values of fields, or of Aggregates,
+        instead of objects. Records aren't added to the session, and One
+        attributes are given as the hash keys of their targets.
+        """
+
+        self.projection.extend([isinstance(field, Field) and field.name or
+                                field for field in fields])
+        return self
+
+    def groupby(self, *fields):
+        """Computes the Aggregates of the projection for each group"""
+
+        self.groupbys.extend([isinstance(field, Field) and field.name or
+                              field for field in fields])
+        return self
+
+    def aggregates(self):
+        return bool(self.projection) and \
+               (bool(self.groupbys) or
+                bool([item for item in self.projection
+                      if isinstance(item, Aggregate)]))
+
+    def record(self):
+        """
+        Returns the namedtuple class of the records of the projection. Names
+        that can't be attributes, such as keywords, names starting with an
+        underscore or repeated names, are replaced by _ and their position.
+        """
+
+        names = tuple([isinstance(item, Aggregate) and item.name or item
+                       for item in self.projection])
+        if names not in _records:
+            _records[names] = namedtuple('Record', names, rename=True)
+        return _records[names]
+
+    def after(self, key=None):
+        """
+        Orders by the hash key after the orderby fields and returns the
+        results that come after key, the values of those fields followed by
+        the hash key of the last result seen (see Session.pages). Unlike
+        slices, this seeks to the page without going through the results
+        before it.
+        """
+
+        self.keyset = True
+        self.afterkey = key is not None and tuple(key) or None
+        return self
+
     def __getslice__(self, start=0, end=None):
         self.limitclause = LimitClause(start, end)
         return self
 
+    def prepare(self):
+        return Prepared(self)
+
+    def copy(self):
+        select = Select(self.class_, self.constructor)
+        select.whereclause = _copy(self.whereclause)
+        select.orderbyclauses = [OrderByClause(orderbyclause.field,
+                                               orderbyclause.ascending)
+                                 for orderbyclause in self.orderbyclauses]
+        if self.limitclause:
+            select.limitclause = LimitClause(self.limitclause.start,
+                                             self.limitclause.end)
+        select.joins = list(self.joins)
+        select.prefetches = list(self.prefetches)
+        select.projection = list(self.projection)
+        select.groupbys = list(self.groupbys)
+        select.keyset = self.keyset
+        select.afterkey = self.afterkey
+        return select
+
+
+class Prepared(Query):
+    """
+    A copy of a Select that can't be changed anymore, to be run many times
+    with Session.execute given the values of its Params. Backends keep what
+    they compile from it in compiled.
+    """
+
+    def __init__(self, select):
+        self.select = select.copy()
+        self.classname = self.select.classname
+        self.compiled = weakref.WeakKeyDictionary()
+        Query.__init__(self)
+
+    def bind(self, params):
+        """Returns a Select with the values of params in place of Params"""
+
+        select = self.select.copy()
+        select.whereclause = _copy(select.whereclause, params)
+        return select
+
+    def bindvalues(self, values, params):
+        return [bindvalue(value, params) for value in values]
+
+
+class Param(object):
+    """A value of a prepared query given when it is executed"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "%s(%s)" % (util.fullname(self.__class__), repr(self.name))
+
+
+def bindvalue(value, params):
+    """Returns the value of params for value if it is a Param"""
+
+    if not isinstance(value, Param):
+        return value
+    elif value.name not in params:
+        raise ValueError("Missing value for %s" % value.name)
+    return params[value.name]
+
+
+def _after(prefix):
+    """
+    Returns the lowest text greater than every text starting with prefix, or
+    None if there is none.
+    """
+
+    top = isinstance(prefix, unicode) and sys.maxunicode or 255
+    while prefix and ord(prefix[-1]) >= top:
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+
+    char = isinstance(prefix, unicode) and unichr or chr
+    return prefix[:-1] + char(ord(prefix[-1]) + 1)
+
+
+def _copy(whereclause, params=None):
+    if params is None:
+        bind = lambda value: value
+    else:
+        bind = lambda value: bindvalue(value, params)
+
+    if whereclause is None:
+        return None
+    elif isinstance(whereclause, CompareWhereClause):
+        return CompareWhereClause(bind(whereclause.value1),
+                                  whereclause.comparator,
+                                  bind(whereclause.value2))
+    elif isinstance(whereclause, InWhereClause):
+        return InWhereClause(whereclause.field,
+                             [bind(value) for value in whereclause.values])
+    elif isinstance(whereclause, BetweenWhereClause):
+        return BetweenWhereClause(whereclause.field, bind(whereclause.low),
+                                  bind(whereclause.high))
+    elif isinstance(whereclause, LikeWhereClause):
+        return LikeWhereClause(whereclause.field, bind(whereclause.pattern))
+    elif isinstance(whereclause, NullWhereClause):
+        return NullWhereClause(whereclause.field, whereclause.null)
+    else:
+        return whereclause.__class__(_copy(whereclause.whereclause1, params),
+                                     _copy(whereclause.whereclause2, params))
+
 
 class Field:
 
@@ -109,6 +293,34 @@ class Field:
     def __le__(self, other):
         return CompareWhereClause(self, '<=', other)
 
+    def in_(self, values):
+        return InWhereClause(self, values)
+
+    def between(self, low, high):
+        return BetweenWhereClause(self, low, high)
+
+    def like(self, pattern):
+        """Matches pattern, where % is any text and _ any character"""
+
+        return LikeWhereClause(self, pattern)
+
+    def startswith(self, prefix):
+        """
+        Matches the values starting with prefix, telling case apart unlike
+        LIKE does. It is a range of values, so an index on the field is used.
+        """
+
+        after = _after(prefix)
+        if after is None:
+            return self >= prefix
+        return (self >= prefix) & (self < after)
+
+    def isnull(self):
+        return NullWhereClause(self, True)
+
+    def notnull(self):
+        return NullWhereClause(self, False)
+
 
 class WhereClause(object):
 
@@ -133,6 +345,42 @@ class CompareWhereClause(WhereClause):
         WhereClause.__init__(self)
 
 
+class InWhereClause(WhereClause):
+
+    def __init__(self, field, values):
+        self.field = field
+        self.values = tuple(values)
+        WhereClause.__init__(self)
+
+
+class BetweenWhereClause(WhereClause):
+
+    def __init__(self, field, low, high):
+        self.field = field
+        self.low = low
+        self.high = high
+        WhereClause.__init__(self)
+
+
+class LikeWhereClause(WhereClause):
+
+    # Escapes % and _ in patterns
+    escape = '\\'
+
+    def __init__(self, field, pattern):
+        self.field = field
+        self.pattern = pattern
+        WhereClause.__init__(self)
+
+
+class NullWhereClause(WhereClause):
+
+    def __init__(self, field, null=True):
+        self.field = field
+        self.null = null
+        WhereClause.__init__(self)
+
+
 class AndWhereClause(WhereClause):
 
     def __init__(self, whereclause1, whereclause2):
@@ -149,6 +397,49 @@ class OrWhereClause(WhereClause):
         WhereClause.__init__(self)
 
 
+class Aggregate(object):
+    """
+    A value computed over the rows of a Select, or over each group of rows.
+    Null values are left out. The field is named after function and field
+    in the records unless name is given.
+    """
+
+    function = None
+
+    def __init__(self, field, name=None):
+        self.field = isinstance(field, Field) and field.name or field
+        self.name = name or "%s_%s" % (self.function.lower(), self.field)
+
+    def shape(self):
+        return (self.__class__, self.field, self.name)
+
+
+class Count(Aggregate):
+    """Counts the rows, or the rows where field is not null"""
+
+    function = 'COUNT'
+
+    def __init__(self, field=None, name=None):
+        if field is None and name is None:
+            name = 'count'
+        Aggregate.__init__(self, field, name)
+
+
+class Sum(Aggregate):
+
+    function = 'SUM'
+
+
+class Min(Aggregate):
+
+    function = 'MIN'
+
+
+class Max(Aggregate):
+
+    function = 'MAX'
+
+
 class OrderByClause(object):
 
     def __init__(self, field, ascending=True):
@@ -28,6 +28,8 @@ from UserDict import DictMixin
 
 from . import exceptions
 from . import util
+from .collection import Collection
+from .query import LimitClause
 
 class Session(DictMixin):
 
@@ -37,35 +39,122 @@ class Session(DictMixin):
         self._objs = {}
         self._commited = {}
         self._deleted = {}
+        # Collections with appends or removes not written yet, by id
+        self._collections = {}
+        self.closed = False
         self.connectedbackend = self.connection.backend.connect(self)
 
     def gettable(self, obj=None, classname=None, class_=None):
         classname = classname or util.fullname(class_ or obj.__class__)
         if classname not in self.connection.tables:
-            raise exceptions.NotMapped(obj.__class__)
+            raise exceptions.NotMapped(class_ or obj.__class__)
         return self.connection.tables[classname]
 
     def gethashkey(self, obj):
         return self.connectedbackend.gethashkey(obj)
 
+    def gethashkeys(self, objs):
+        return self.connectedbackend.gethashkeys(objs)
+
     def getfullhashkey(self, obj):
         try:
             return self.connectedbackend.getfullhashkey(obj)
         except exceptions.NotMapped:
             return 0
 
+    def changed(self, collection):
+        self._collections[id(collection)] = collection
+
+    def prefetch(self, objs, *names, **kwargs):
+        """
+        Loads the Many attributes names of objs, with one query per attribute
+        for all the objects of each table. The objects loaded are added to
+        the session unless track is False.
+        """
+
+        track = True
+
+        if 'track' in kwargs:
+            track = kwargs['track']
+
+        groups = {}
+        for obj in util.flatten(objs):
+            if obj is not None:
+                groups.setdefault(self.gettable(obj), []).append(obj)
+
+        for table, objs in groups.items():
+            for name in names:
+                results = self.connectedbackend.getcollections(table, name,
+                                                               objs)
+                for obj, values in zip(objs, results):
+                    if track:
+                        self.append(values, dirty=False, recursive=True)
+
+                    if self.connectedbackend.sharesobjects:
+                        # A collection bound to this session can't be set on
+                        # an instance other sessions get too
+                        obj.__dict__[name] = list(values)
+                        continue
+
+                    collection = obj.__dict__.get(name)
+                    if not isinstance(collection, Collection):
+                        collection = Collection(self, obj, name)
+                        obj.__dict__[name] = collection
+                    collection.setloaded(values)
+
     def commit(self):
-        for value, fullhashkey in self._objs.values():
-            if self.getfullhashkey(value) != fullhashkey or True:
-                self.connectedbackend.insert(value)
+        collections = self._collections.values()
+        self._collections = {}
+        for collection in collections:
+            collection.flush()
+
+        inserted = []
+        fullhashkeys = {}
+        for hashkey, (value, fullhashkey) in self._objs.items():
+            newfullhashkey = self.getfullhashkey(value)
+            if newfullhashkey != fullhashkey:
+                inserted.append(value)
+                fullhashkeys[hashkey] = (value, newfullhashkey)
+
+        for table, objs in self._flushplan(inserted):
+            self.connectedbackend.insert(objs)
+
+        deleted = [value for value, fullhashkey in self._deleted.values()]
+        for table, objs in reversed(self._flushplan(deleted)):
+            self.connectedbackend.delete(objs)
 
-        if self._deleted:
-            self.connectedbackend.delete([value[0] for value in
-                                          self._deleted.values()])
         self.connectedbackend.commit()
-        self._commited.update(self._objs)
+        # Only now, so that the objects are inserted again if it fails
+        self._objs.update(fullhashkeys)
+        self._commited = dict(self._objs)
+        self._deleted = {}
+
+        if self.connection.resultcache is not None:
+            self.connection.resultcache.invalidate(
+                *set([self.gettable(obj).name for obj in inserted + deleted]))
+        if self.connection.objectcache is not None:
+            for table, objs in self._flushplan(inserted + deleted):
+                self.connection.objectcache.invalidate(
+                    self.connection.backend, table.name,
+                    self.gethashkeys(objs))
+
+    def _flushplan(self, objs):
+        """
+        Groups objs by table, with the tables pointed to by foreign keys
+        before the tables that point to them.
+        """
+
+        groups = {}
+        for obj in objs:
+            groups.setdefault(self.gettable(obj), []).append(obj)
+
+        return [(table, groups[table])
+                for table in self.connection.sorttables(groups.keys())]
 
     def rollback(self):
+        for collection in self._collections.values():
+            collection.unload()
+        self._collections = {}
         self.connectedbackend.rollback()
         self._objs = {}
         self._objs.update(self._commited)
@@ -87,15 +176,14 @@ class Session(DictMixin):
         if 'recursive' in kwargs:
             recursive = kwargs['recursive']
 
-        for obj in util.flatten(objs):
-            if obj is None:
-                continue
-
-            hashkey = self.gethashkey(obj)
+        objs = [obj for obj in util.flatten(objs) if obj is not None]
+        for obj, hashkey in zip(objs, self.gethashkeys(objs)):
             recursive = recursive and (dirty or hashkey not in self)
 
             if dirty:
                 self[hashkey] = None
+                if hashkey in self._deleted:
+                    del self._deleted[hashkey]
 
             self[hashkey] = obj
 
@@ -103,8 +191,12 @@ class Session(DictMixin):
                 table = self.gettable(obj)
                 for foreignkey in table.foreignkeys.values():
                     if foreignkey.datatype.autofetch:
-                        self.append(getattr(obj, foreignkey.name), dirty=False,
-                                    recursive=True)
+                        value = getattr(obj, foreignkey.name)
+                        if (isinstance(value, Collection) and
+                            not value.loaded):
+                            # Not worth loading just to add them
+                            continue
+                        self.append(value, dirty=False, recursive=True)
 
 
     def remove(self, obj, delete=False):
@@ -146,6 +238,7 @@ class Session(DictMixin):
         self._objs = {}
         self._commited = {}
         self._deleted = {}
+        self._collections = {}
 
     ##########################
     # WITH
@@ -160,6 +253,7 @@ class Session(DictMixin):
             self.commit()
 
         self.connectedbackend.disconnect()
+        self.closed = True
 
     ##########################
     # QUERY
@@ -167,16 +261,161 @@ class Session(DictMixin):
     def get(self, class_, hashkey):
         if hashkey in self:
             return self[hashkey]
-        else:
-            table = self.gettable(class_=class_)
+
+        table = self.gettable(class_=class_)
+        objectcache = self.connection.objectcache
+        if objectcache is None:
             return self.connectedbackend.get(table, hashkey)
 
-    def queryone(self, query):
-        results = list(self.query(query[:1]))
+        obj = objectcache.get(self, table, hashkey)
+        if obj is None:
+            generation = objectcache.generation(self.connection.backend,
+                                                 table.name)
+            obj = self.connectedbackend.get(table, hashkey)
+            if obj is not None:
+                objectcache.put(self, table, hashkey, obj, generation)
+        return obj
+
+    def getmany(self, class_, hashkeys):
+        """
+        Returns the objects of class_ with hashkeys, None for the ones that
+        don't exist. Objects in the session are served from it and the rest
+        are fetched at once.
+        """
+
+        hashkeys = list(hashkeys)
+        missing = [hashkey for hashkey in hashkeys
+                   if hashkey not in self._objs]
+        table = self.gettable(class_=class_)
+        objectcache = self.connection.objectcache
+
+        found = {}
+        if objectcache is not None:
+            for hashkey in set(missing):
+                obj = objectcache.get(self, table, hashkey)
+                if obj is not None:
+                    found[hashkey] = obj
+            missing = [hashkey for hashkey in missing if hashkey not in found]
+            generation = objectcache.generation(self.connection.backend,
+                                                 table.name)
+
+        if missing:
+            loaded = dict(zip(missing, self.connectedbackend.getmany(table,
+                                                                     missing)))
+            if objectcache is not None:
+                for hashkey, obj in loaded.items():
+                    if obj is not None:
+                        objectcache.put(self, table, hashkey, obj, generation)
+            found.update(loaded)
+
+        objs = []
+        for hashkey in hashkeys:
+            if hashkey in self._objs:
+                objs.append(self[hashkey])
+            else:
+                objs.append(found[hashkey])
+        return objs
+
+    def execute(self, prepared, **params):
+        """Runs the Prepared query with the values of its Params in params"""
+
+        for obj in self.connectedbackend.execute(prepared, params):
+            if not prepared.select.projection:
+                self.append(obj, dirty=False, recursive=True)
+            yield obj
+
+    def pages(self, select, size=100, track=True):
+        """
+        Yields the results of select in lists of size objects. Each page is
+        queried from the key of the last object of the one before it (see
+        Select.after), so deep pages cost the same as the first one.
+        """
+
+        key = None
+        while True:
+            page = select.copy().after(key)
+            page.limitclause = LimitClause(0, size)
+            results = list(self.query(page, track))
+            if results:
+                yield results
+            if len(results) < size:
+                break
+            key = self.keyof(results[-1], select)
+
+    def keyof(self, obj, select):
+        """
+        Returns the key of obj in the results of select: the values of the
+        ordered fields followed by the hash key.
+        """
+
+        return tuple([getattr(obj, orderbyclause.field)
+                      for orderbyclause in select.orderbyclauses] +
+                     [self.gethashkey(obj)])
+
+    def _cachedquery(self, query, key, track):
+        """
+        Returns the results of query, taking the hash keys of the objects (or
+        the records) from the ResultCache of the connection if they are in
+        it.
+        """
+
+        resultcache = self.connection.resultcache
+        table = self.connection.tables[query.classname]
+
+        results = resultcache.get(key)
+        if results is None:
+            generation = resultcache.generation(table.name)
+            objs = list(self.connectedbackend.query(query, track))
+            if query.projection:
+                resultcache.put(key, table.name, generation, objs)
+                return objs
+            resultcache.put(key, table.name, generation,
+                            self.gethashkeys(objs))
+        elif query.projection:
+            return list(results)
+        elif track:
+            objs = [obj for obj in self.getmany(query.class_, results)
+                    if obj is not None]
+        else:
+            objs = [obj for obj in self.connectedbackend.getmany(table,
+                                                                 results)
+                    if obj is not None]
+
+        if track:
+            for obj in objs:
+                self.append(obj, dirty=False, recursive=True)
+        if results is not None and query.prefetches:
+            self.prefetch(objs, *query.prefetches, track=track)
+        return objs
+
+    def queryone(self, query, track=True):
+        results = list(self.query(query[:1], track))
         return len(results) > 0 and results[0] or None
 
-    def query(self, query):
-        objs = self.connectedbackend.query(query)
-        for obj in util.flatten(objs):
+    def query(self, query, track=True):
+        """
+        Yields the results of query, adding them to the session. With track
+        False the objects are just read: they aren't hashed or added to the
+        session, so changes to them aren't written and each query (or page
+        of results) builds its own instances.
+        """
+
+        resultcache = self.connection.resultcache
+        if (resultcache is not None and
+            query.constructor is query.class_):
+            key = self.connectedbackend.cachekey(query)
+            if key is not None:
+                for obj in self._cachedquery(query, key, track):
+                    yield obj
+                return
+
+        objs = self.connectedbackend.query(query, track)
+        if query.projection or not track:
+            # Records aren't objects of the session
+            for obj in objs:
+                yield obj
+            return
+
+        for obj in objs:
             self.append(obj, dirty=False, recursive=True)
             yield obj
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Copyright (C) 2008  César Izurieta
+
+This file is part of Cryo.
+
+Cryo is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+__author__ = "César Izurieta"
+__email__ = "cesar at caih dot org"
+__version__ = "$Revision$"[11:-2]
+
+import unittest
+
+from cryo.cache import ResultCache
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def test_lru(self):
+        cache = ResultCache(size=2)
+        cache.put('a', 'table', 0, [1])
+        cache.put('b', 'table', 0, [2])
+        self.assertEquals(cache.get('a'), (1, ))
+
+        # b is the least recently used
+        cache.put('c', 'other', 0, [3])
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), (1, ))
+        self.assertEquals(cache.get('c'), (3, ))
+        self.assertEquals(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1,
+                                          'evictions': 1,
+                                          'invalidations': 0})
+
+    def test_invalidate(self):
+        cache = ResultCache()
+        cache.put('a', 'table', 0, [1])
+        cache.put('b', 'other', 0, [2])
+        generation = cache.generation('table')
+
+        cache.invalidate('table')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b'), (2, ))
+        self.assertEquals(cache.stats()['invalidations'], 1)
+
+        # Results read before the invalidation aren't cached
+        cache.put('a', 'table', generation, [1])
+        self.assertEquals(cache.get('a'), None)
+        cache.put('a', 'table', cache.generation('table'), [1])
+        self.assertEquals(cache.get('a'), (1, ))
+
+        cache.clear()
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b'), None)
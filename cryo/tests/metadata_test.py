@@ -24,9 +24,11 @@ __author__ = "César Izurieta"
 __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
+import pickle
 import unittest
 
 from cryo import datatypes
+from cryo.metadata import Table, Index
 
 from . import testclasses
 
@@ -67,3 +69,24 @@ class TableTestCase(unittest.TestCase):
 
             else:
                 self.fail("Table %s should not exist" % table.name)
+
+    def test_pickle(self):
+        for table in testclasses.gethashkeytables():
+            copy = pickle.loads(pickle.dumps(table, 2))
+            self.assertEquals(copy.classname, table.classname)
+            self.assertEquals(repr(copy.hashkey), repr(table.hashkey))
+            self.assertEquals(copy.hashkey.hashkey(copy, (1, ), ['1']),
+                              table.hashkey.hashkey(table, (1, ), ['1']))
+
+    def test_indexes(self):
+        table, = testclasses.getindextables()
+        self.assertEquals([(index.columns, index.name, index.unique)
+                           for index in table.indexes],
+                          [(('code', ), 'IndexTestClass_code_index', True),
+                           (('group', 'number'),
+                            'IndexTestClass_group_number_index', False),
+                           (('number', ), 'IndexTestClass_number_index',
+                            False)])
+
+        self.assertRaises(ValueError, Table, testclasses.IndexTestClass,
+                          indexes=[Index('missing')])
@@ -27,8 +27,9 @@ __version__ = "$Revision$"[11:-2]
 from datetime import datetime
 from enum import Enum
 
-from cryo.metadata import Table
-from cryo.datatypes import One, Many, PythonObject
+from cryo.metadata import Table, Column, Index
+from cryo.datatypes import One, Many, PythonObject, Text
+from cryo.hashkeys import Digest, IntegerKey
 
 TestEnum = Enum('first', 'second', 'third')
 
@@ -81,6 +82,50 @@ class ForeignKeyTestClassMany:
         self.one_autofetch = foreignkeytest or ForeignKeyTestClass()
 
 
+class IntegerKeyTestClass:
+
+    def __init__(self, id=0, name=''):
+        self.id = id
+        self.name = name
+
+
+class DigestKeyTestClass:
+
+    def __init__(self, name='', integerkey=None):
+        self.name = name
+        self.integerkey = integerkey
+
+
+class CycleKeyTestClass:
+
+    def __init__(self, name='', other=None):
+        self.name = name
+        self.other = other
+
+
+class LazyTestClass:
+
+    def __init__(self, name='', target=None):
+        self.name = name
+        self.target = target
+
+
+class PythonObjectKeyTestClass:
+
+    def __init__(self, name='', value=None):
+        self.name = name
+        self.value = value
+
+
+class IndexTestClass:
+
+    def __init__(self, name='', group='', number=0, code=None):
+        self.name = name
+        self.group = group
+        self.number = number
+        self.code = code
+
+
 def gettables():
     return [Table(CompleteTestClass,
                   primarykey=('name',),
@@ -99,3 +144,30 @@ def gettables():
                   attributes={'one': One(ForeignKeyTestClass, inverse='many'),
                               'one_autofetch': One(ForeignKeyTestClass,
                                                    inverse='many_autofetch')})]
+
+
+def gethashkeytables():
+    return [Table(IntegerKeyTestClass,
+                  primarykey=('id',),
+                  hashkey=IntegerKey()),
+            Table(DigestKeyTestClass,
+                  primarykey=('name',),
+                  attributes={'integerkey': One(IntegerKeyTestClass)},
+                  hashkey=Digest('md5', length=8, binary=True)),
+            Table(CycleKeyTestClass,
+                  primarykey=('name', 'other'),
+                  attributes={'other': One(CycleKeyTestClass)}),
+            Table(LazyTestClass,
+                  primarykey=('name',),
+                  attributes={'target': One(IntegerKeyTestClass,
+                                            autofetch=False)}),
+            Table(PythonObjectKeyTestClass,
+                  primarykey=('name', 'value'),
+                  attributes={'value': PythonObject()})]
+
+
+def getindextables():
+    return [Table(IndexTestClass,
+                  primarykey=('name',),
+                  attributes={'code': Column('code', Text(10), unique=True)},
+                  indexes=[Index(('group', 'number')), Index('number')])]
@@ -25,6 +25,7 @@ __email__ = "cesar at caih dot org"
 __version__ = "$Revision$"[11:-2]
 
 import inspect
+import itertools
 import logging
 
 QUERY_LOGGER = logging.getLogger('cryo.query')
@@ -105,6 +106,26 @@ def flatten(iterable, containers=(list, tuple)):
     return iterable
 
 
+def chunks(iterable, size):
+    """
+    Splits an iterable in lists of at most size items, consuming it only as
+    the lists are needed.
+
+    For example:
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    >>> list(chunks([], 2))
+    []
+    """
+
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
 def issubclass_(obj, type_):
     """
     Checks is obj is a class and is a subclass of type_.